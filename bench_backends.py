@@ -0,0 +1,114 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Compare storage backends on the same synthetic workload
+
+Usage: ./bench_backends.py [sqlite] [mysql]
+All tables of the benchmark databases are dropped first,
+so BENCH_MYSQL_CONFIG must not point at real data.
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+from rs_db_connection import BatchInserter, RSDBConnection
+
+
+BENCH_MYSQL_CONFIG = {
+    "user": "madzia",
+    "host": "localhost",
+    "database": "bgg_bench",
+}
+
+NUM_GAMES = 2000
+NUM_USERS = 2000
+RATINGS_PER_USER = 50
+POINT_QUERIES = 1000
+
+TABLES = [
+    "gameratingcounts", "gameratings", "users", "gamemechanics",
+    "mechanics", "gamecategories", "categories", "games", "schemaversion",
+    "ratingsversion", "gamesversion",
+]
+
+
+def timed(results, step, fun, *args):
+    start = time.time()
+    result = fun(*args)
+    results.append((step, time.time() - start))
+    return result
+
+
+def fill(rsdbc):
+    """Insert synthetic games, users and ratings"""
+    rng = random.Random(0)
+    batches = BatchInserter(rsdbc.cnx, rsdbc.cursor)
+    batches.add_table("games", "insert ignore into games")
+    batches.add_table("users", "insert ignore into users")
+    batches.add_table("gameratings", "insert ignore into gameratings")
+    for game_id in range(1, NUM_GAMES + 1):
+        batches.add("games", (
+            game_id, 2000, 2, 4, "Game {}".format(game_id), 10, "",
+            NUM_USERS, 7.0, 3, "None"))
+    for user_id in range(1, NUM_USERS + 1):
+        batches.add("users", (user_id, "user{}".format(user_id)))
+        # popular games get most of the ratings
+        games = set(int(NUM_GAMES * rng.betavariate(1, 4)) + 1
+                    for _ in range(RATINGS_PER_USER))
+        for game_id in games:
+            batches.add("gameratings", (
+                user_id, game_id, float(rng.randint(1, 10))))
+    batches.flush()
+    rsdbc.refresh_rating_counts()
+    rsdbc.cursor.execute("select count(*) from gameratings")
+    return rsdbc.cursor.fetchall()[0][0]
+
+
+def point_queries(rsdbc):
+    for i in range(POINT_QUERIES):
+        rsdbc.get_game_name(i % NUM_GAMES + 1)
+        rsdbc.get_user_ratings(i % NUM_USERS + 1)
+
+
+def sessions(config):
+    for i in range(POINT_QUERIES):
+        with RSDBConnection(config) as rsdbc:
+            rsdbc.get_user_id("user{}".format(i % NUM_USERS + 1))
+
+
+def bench(config):
+    results = []
+    rsdbc = RSDBConnection(config)
+    for table in TABLES:
+        rsdbc.cursor.execute("drop table if exists {}".format(table))
+    timed(results, "create tables", rsdbc.create_tables)
+    num_ratings = timed(results, "insert ratings", fill, rsdbc)
+    results[-1] = ("insert {} ratings".format(num_ratings), results[-1][1])
+    timed(results, "get_data_for_rs", rsdbc.get_data_for_rs)
+    timed(results, "{} x2 point queries".format(POINT_QUERIES),
+          point_queries, rsdbc)
+    timed(results, "100 x suggest_games_to_rate",
+          lambda: [rsdbc.suggest_games_to_rate(user_id)
+                   for user_id in range(1, 101)])
+    rsdbc.finalize()
+    timed(results, "{} sessions".format(POINT_QUERIES), sessions, config)
+    return results
+
+
+if __name__ == "__main__":
+    backends = sys.argv[1:] or ["sqlite", "mysql"]
+    for backend in backends:
+        if backend == "sqlite":
+            directory = tempfile.mkdtemp()
+            config = {
+                "backend": "sqlite",
+                "path": os.path.join(directory, "bench.sqlite"),
+            }
+        else:
+            config = BENCH_MYSQL_CONFIG
+        print "Backend:", backend
+        for step, seconds in bench(config):
+            print "{:>10.3f}s  {}".format(seconds, step)
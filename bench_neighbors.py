@@ -0,0 +1,105 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Measure recall@k of the approximate neighbor index against exact Pearson
+
+Usage: ./bench_neighbors.py [number of users]
+Ratings are synthetic: users and games get random tastes,
+so that users really have similar and dissimilar ones.
+"""
+
+import sys
+import time
+
+import numpy as np
+
+from neighbor_index import RandomProjectionIndex, bits_for
+from ratings_matrix import from_sorted_arrays
+from recommenders import pearson_block, pearson_terms
+
+
+NUM_USERS = 20000
+NUM_GAMES = 5000
+RATINGS_PER_USER = 60
+TASTE_DIMENSIONS = 6
+QUERIES = 200
+K = 50
+
+# (tables, bits, multiprobe); bits of None are chosen from number of users,
+# bits <= 0 are added to the chosen number
+SETTINGS = [
+    (4, None, False),
+    (8, None, False),
+    (8, None, True),
+    (16, None, True),
+    (16, -2, True),
+]
+
+
+def synthetic_ratings(num_users, rng):
+    users = rng.standard_normal((num_users, TASTE_DIMENSIONS))
+    games = rng.standard_normal((NUM_GAMES, TASTE_DIMENSIONS))
+    user_ids, game_ids, ratings = [], [], []
+    for user in range(num_users):
+        # popular games get most of the ratings
+        rated = np.unique((NUM_GAMES * rng.beta(1, 4, RATINGS_PER_USER))
+                          .astype(np.int64))
+        taste = games[rated].dot(users[user]) / np.sqrt(TASTE_DIMENSIONS)
+        noise = rng.standard_normal(len(rated))
+        user_ids.append(np.repeat(user + 1, len(rated)))
+        game_ids.append(rated + 1)
+        ratings.append(np.clip(np.round(6 + 2 * taste + noise), 1, 10))
+    return from_sorted_arrays(np.concatenate(user_ids),
+                              np.concatenate(game_ids),
+                              np.concatenate(ratings))
+
+
+def exact_kth(terms, row, k):
+    """Return similarity of the k-th most similar user"""
+    similarity = pearson_block(terms, row, row + 1)[0]
+    similarity[row] = np.nan
+    similarity = similarity[~np.isnan(similarity)]
+    if len(similarity) < k:
+        return -np.inf
+    return np.partition(-similarity, k - 1)[k - 1] * -1
+
+
+def recall(found, kth):
+    """Return part of the exact k best users found;
+    with ties at the k-th place any of the tied users counts
+    """
+    return np.sum(found >= kth) / float(K)
+
+
+def bench(ratings, queries):
+    terms = pearson_terms(ratings.matrix)
+    start = time.time()
+    exact = [exact_kth(terms, row, K) for row in queries]
+    exact_time = (time.time() - start) / len(queries)
+    print "{} users, exact: {:.2f}ms per user".format(
+        ratings.shape[0], 1000 * exact_time)
+    print "tables bits probe   build   query  candidates  recall@{}".format(K)
+    for tables, bits, multiprobe in SETTINGS:
+        if bits is not None and bits <= 0:
+            bits = bits_for(ratings.shape[0]) + bits
+        start = time.time()
+        index = RandomProjectionIndex(ratings, tables, bits, multiprobe)
+        build_time = time.time() - start
+        start = time.time()
+        found = [index.query(row, K)[1] for row in queries]
+        query_time = (time.time() - start) / len(queries)
+        candidates = np.mean([len(index.candidates(index.codes[row]))
+                              for row in queries])
+        mean_recall = np.mean([recall(similarities, kth)
+                               for similarities, kth in zip(found, exact)])
+        print "{:>6} {:>4} {:>5} {:>6.2f}s {:>5.2f}ms {:>11.0f} {:>9.3f}".format(
+            tables, index.num_bits, multiprobe and "yes" or "no",
+            build_time, 1000 * query_time, candidates, mean_recall)
+
+
+if __name__ == "__main__":
+    rng = np.random.RandomState(0)
+    num_users = int(sys.argv[1]) if len(sys.argv) > 1 else NUM_USERS
+    ratings = synthetic_ratings(num_users, rng)
+    queries = rng.choice(num_users, min(QUERIES, num_users), replace=False)
+    bench(ratings, queries)
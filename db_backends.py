@@ -0,0 +1,596 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Storage backends of RSDBConnection: a MySQL server or an embedded SQLite
+database file.
+
+A backend is chosen by the "backend" key of the connection config
+("mysql" when missing); the rest of the config is passed to the backend:
+MySQL connection arguments, or {"backend": "sqlite", "path": "bgg.sqlite"}.
+Queries are written in the MySQL dialect, the SQLite backend translates
+the few constructs SQLite spells differently.
+"""
+
+import re
+import sqlite3
+import threading
+import time
+
+try:
+    import mysql.connector
+    from mysql.connector import errorcode
+except ImportError:
+    mysql = None
+
+
+# Maximum number of connections open at once for a single config
+CONNECTION_POOL_SIZE = 8
+# Idle connections older than this (in seconds) are pinged before reuse
+CONNECTION_POOL_PING_AFTER = 30
+
+# Number of compiled statements sqlite3 keeps per connection
+SQLITE_CACHED_STATEMENTS = 256
+
+BACKENDS = {}
+BACKENDS_LOCK = threading.Lock()
+
+MYSQL_SCHEMA = [
+    """
+        create table if not exists games (
+            id int not null primary key,
+            yearpublished int,
+            minplayers int,
+            maxplayers int,
+            name varchar(64),
+            age int,
+            description varchar(512),
+            noofratings int,
+            avgrating real,
+            bestnumplayers int,
+            langdependence varchar(256)
+        )
+    """,
+    """
+        create table if not exists categories (
+            id int not null auto_increment,
+            name varchar(64) unique,
+            primary key (id)
+        )
+    """,
+    """
+        create table if not exists gamecategories (
+            game_id int not null,
+            foreign key (game_id) references games(id),
+            category_id int not null,
+            foreign key (category_id) references categories(id)
+        )
+    """,
+    """
+        create table if not exists mechanics (
+            id int not null auto_increment,
+            name varchar(64) unique,
+            primary key(id)
+        )
+    """,
+    """
+        create table if not exists gamemechanics (
+            game_id int not null,
+            foreign key (game_id) references games(id),
+            mechanic_id int not null,
+            foreign key (mechanic_id) references mechanics(id)
+        )
+    """,
+    """
+        create table if not exists users (
+            id int not null auto_increment,
+            name varchar(64),
+            primary key(id)
+        )
+    """,
+    """
+        create table if not exists gameratings (
+            user_id int not null,
+            foreign key (user_id) references users(id),
+            game_id int not null,
+            foreign key (game_id) references games(id),
+            rating float,
+            primary key (user_id, game_id)
+        )
+    """,
+    """
+        create table if not exists gameratingcounts (
+            game_id int not null primary key,
+            noofratings int not null
+        )
+    """,
+]
+
+
+# Fills the emptied gameratingcounts; only ratings of known games count
+COUNT_RATINGS = """
+    insert into gameratingcounts (game_id, noofratings)
+    select r.game_id, count(r.user_id) from gameratings r
+    join games g on g.id = r.game_id
+    group by r.game_id
+"""
+
+
+def index_missing(table, index):
+    """Return guard of a migration step adding given index
+    ("PRIMARY" for the primary key) to table
+    """
+    return """
+        select count(*) = 0 from information_schema.statistics
+        where table_schema = database()
+        and table_name = '{}' and index_name = '{}'
+    """.format(table, index)
+
+
+# Schema changes applied (in order) on top of MYSQL_SCHEMA.
+# Every migration is (version, list of steps); applied versions
+# are remembered in the schemaversion table. A step is a statement,
+# or (guard, statement): the statement runs only if the guard query
+# returns true. MySQL commits every DDL statement at once, so a migration
+# failing halfway is run again from its first step: every step has to
+# be harmless when it already ran, DDL steps are guarded.
+MYSQL_MIGRATIONS = [
+    (1, [
+        # drop users ingested more than once, keeping the first copy
+        """
+        delete r from gameratings r
+        join users u on u.id = r.user_id
+        join users k on k.name = u.name and k.id < u.id
+        """,
+        """
+        delete u from users u
+        join users k on k.name = u.name and k.id < u.id
+        """,
+        (index_missing("users", "users_name"),
+         "alter table users add unique index users_name (name)"),
+    ]),
+    (2, [
+        # gameratingcounts for databases created before it existed
+        """
+        create table if not exists gameratingcounts (
+            game_id int not null primary key,
+            noofratings int not null
+        )
+        """,
+        "delete from gameratingcounts",
+        COUNT_RATINGS,
+    ]),
+    (3, [
+        (index_missing("gameratings", "gameratings_game"),
+         """
+         create index gameratings_game
+         on gameratings (game_id, user_id, rating)
+         """),
+        (index_missing("gameratingcounts", "gameratingcounts_noofratings"),
+         """
+         create index gameratingcounts_noofratings
+         on gameratingcounts (noofratings, game_id)
+         """),
+        (index_missing("games", "games_noofratings"),
+         "create index games_noofratings on games (noofratings)"),
+    ]),
+    (4, [
+        # link tables had no key, so they may contain duplicates;
+        # they are deduplicated until the key is there
+        (index_missing("gamecategories", "PRIMARY"),
+         """
+         create temporary table if not exists gamecategories_distinct
+         select distinct game_id, category_id from gamecategories
+         """),
+        (index_missing("gamecategories", "PRIMARY"),
+         "delete from gamecategories"),
+        (index_missing("gamecategories", "PRIMARY"),
+         "insert into gamecategories select * from gamecategories_distinct"),
+        "drop temporary table if exists gamecategories_distinct",
+        (index_missing("gamecategories", "PRIMARY"),
+         "alter table gamecategories add primary key (game_id, category_id)"),
+        (index_missing("gamecategories", "gamecategories_category"),
+         """
+         create index gamecategories_category
+         on gamecategories (category_id)
+         """),
+        (index_missing("gamemechanics", "PRIMARY"),
+         """
+         create temporary table if not exists gamemechanics_distinct
+         select distinct game_id, mechanic_id from gamemechanics
+         """),
+        (index_missing("gamemechanics", "PRIMARY"),
+         "delete from gamemechanics"),
+        (index_missing("gamemechanics", "PRIMARY"),
+         "insert into gamemechanics select * from gamemechanics_distinct"),
+        "drop temporary table if exists gamemechanics_distinct",
+        (index_missing("gamemechanics", "PRIMARY"),
+         "alter table gamemechanics add primary key (game_id, mechanic_id)"),
+        (index_missing("gamemechanics", "gamemechanics_mechanic"),
+         "create index gamemechanics_mechanic on gamemechanics (mechanic_id)"),
+    ]),
+    (5, [
+        # a single row counting changes of ratings,
+        # see RSDBConnection.get_ratings_watermark
+        """
+        create table if not exists ratingsversion (
+            id int not null primary key,
+            created bigint not null,
+            version bigint not null
+        )
+        """,
+        "insert ignore into ratingsversion values (1, unix_timestamp(), 0)",
+    ]),
+    (6, [
+        # a single row counting changes of games,
+        # see RSDBConnection.get_games_fingerprint
+        """
+        create table if not exists gamesversion (
+            id int not null primary key,
+            created bigint not null,
+            version bigint not null
+        )
+        """,
+        "insert ignore into gamesversion values (1, unix_timestamp(), 0)",
+    ]),
+]
+
+
+# Ratings version table of MYSQL_MIGRATIONS version 5
+SQLITE_RATINGS_VERSION = [
+    """
+        create table if not exists ratingsversion (
+            id integer not null primary key,
+            created int not null,
+            version int not null
+        )
+    """,
+    """
+        insert or ignore into ratingsversion values (
+            1, cast((julianday('now') - 2440587.5) * 86400 as integer), 0)
+    """,
+]
+
+# Games version table of MYSQL_MIGRATIONS version 6
+SQLITE_GAMES_VERSION = [
+    """
+        create table if not exists gamesversion (
+            id integer not null primary key,
+            created int not null,
+            version int not null
+        )
+    """,
+    """
+        insert or ignore into gamesversion values (
+            1, cast((julianday('now') - 2440587.5) * 86400 as integer), 0)
+    """,
+]
+
+# Same tables as MYSQL_SCHEMA with all MYSQL_MIGRATIONS applied.
+# Foreign keys are not enforced by SQLite (just like "insert ignore"
+# silently drops rows violating them in MySQL, nothing fails).
+SQLITE_SCHEMA = [
+    """
+        create table if not exists games (
+            id integer not null primary key,
+            yearpublished int,
+            minplayers int,
+            maxplayers int,
+            name varchar(64),
+            age int,
+            description varchar(512),
+            noofratings int,
+            avgrating real,
+            bestnumplayers int,
+            langdependence varchar(256)
+        )
+    """,
+    "create index if not exists games_noofratings on games (noofratings)",
+    """
+        create table if not exists categories (
+            id integer not null primary key,
+            name varchar(64) collate nocase unique
+        )
+    """,
+    """
+        create table if not exists gamecategories (
+            game_id int not null references games(id),
+            category_id int not null references categories(id),
+            primary key (game_id, category_id)
+        )
+    """,
+    """
+        create index if not exists gamecategories_category
+        on gamecategories (category_id)
+    """,
+    """
+        create table if not exists mechanics (
+            id integer not null primary key,
+            name varchar(64) collate nocase unique
+        )
+    """,
+    """
+        create table if not exists gamemechanics (
+            game_id int not null references games(id),
+            mechanic_id int not null references mechanics(id),
+            primary key (game_id, mechanic_id)
+        )
+    """,
+    """
+        create index if not exists gamemechanics_mechanic
+        on gamemechanics (mechanic_id)
+    """,
+    """
+        create table if not exists users (
+            id integer not null primary key,
+            name varchar(64) collate nocase unique
+        )
+    """,
+    """
+        create table if not exists gameratings (
+            user_id int not null references users(id),
+            game_id int not null references games(id),
+            rating float,
+            primary key (user_id, game_id)
+        )
+    """,
+    """
+        create index if not exists gameratings_game
+        on gameratings (game_id, user_id, rating)
+    """,
+    """
+        create table if not exists gameratingcounts (
+            game_id integer not null primary key,
+            noofratings int not null
+        )
+    """,
+    """
+        create index if not exists gameratingcounts_noofratings
+        on gameratingcounts (noofratings, game_id)
+    """,
+] + SQLITE_RATINGS_VERSION + SQLITE_GAMES_VERSION
+
+# Schema changes applied to SQLite databases created before
+# the tables were in SQLITE_SCHEMA
+SQLITE_MIGRATIONS = [
+    (5, SQLITE_RATINGS_VERSION),
+    (6, SQLITE_GAMES_VERSION),
+]
+
+# MySQL constructs rewritten for SQLite, in order
+SQLITE_TRANSLATIONS = [
+    (re.compile(r"%s"), "?"),
+    (re.compile(r"\binsert ignore\b", re.I), "insert or ignore"),
+    (re.compile(r"\brand\(\)", re.I), "random()"),
+    (re.compile(r"\bon duplicate key update\b", re.I),
+     "on conflict do update set"),
+    (re.compile(r"\bvalues\((\w+)\)", re.I), r"excluded.\1"),
+]
+
+
+class ConnectionPool:
+    """Bounded pool of open database connections.
+
+    Connections are reused instead of being opened for every operation;
+    one that has been idle for a while is pinged before it is handed out
+    and replaced if it is dead.
+    `connect` opens a new connection, `ping` (if given) raises one of
+    `errors` for a dead one, `reset` prepares a returned one for reuse.
+    """
+
+    def __init__(self, connect, errors, ping=None, reset=None,
+                 size=CONNECTION_POOL_SIZE,
+                 ping_after=CONNECTION_POOL_PING_AFTER):
+        self.connect = connect
+        self.errors = errors
+        self.ping = ping
+        self.reset = reset
+        self.ping_after = ping_after
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def is_healthy(self, cnx, idle_since):
+        if self.ping is None or time.time() - idle_since < self.ping_after:
+            return True
+        try:
+            self.ping(cnx)
+        except self.errors:
+            return False
+        return True
+
+    def acquire(self):
+        """Return a connection, blocking while all of them are in use"""
+        self.slots.acquire()
+        try:
+            while True:
+                with self.lock:
+                    if not self.idle:
+                        break
+                    cnx, idle_since = self.idle.pop()
+                if self.is_healthy(cnx, idle_since):
+                    return cnx
+                try:
+                    cnx.close()
+                except self.errors:
+                    pass
+            return self.connect()
+        except:
+            self.slots.release()
+            raise
+
+    def release(self, cnx):
+        try:
+            if self.reset is not None:
+                self.reset(cnx)
+            with self.lock:
+                self.idle.append((cnx, time.time()))
+        except self.errors:
+            pass
+        finally:
+            self.slots.release()
+
+
+class MySQLBackend:
+    """MySQL server, connected to with mysql.connector"""
+
+    name = "mysql"
+    schema = MYSQL_SCHEMA
+    migrations = MYSQL_MIGRATIONS
+    explain = "explain "
+
+    def __init__(self, config):
+        if mysql is None:
+            raise ImportError("mysql.connector is needed by the MySQL backend")
+        self.Error = mysql.connector.Error
+        self.pool = ConnectionPool(
+            lambda: mysql.connector.connect(**config),
+            mysql.connector.Error,
+            ping=lambda cnx: cnx.ping(),
+            reset=self.reset)
+
+    def reset(self, cnx):
+        if cnx.unread_result:
+            cnx.consume_results()
+
+    def acquire(self):
+        return self.pool.acquire()
+
+    def release(self, cnx):
+        self.pool.release(cnx)
+
+    def cursor(self, cnx):
+        return cnx.cursor()
+
+    def describe_error(self, err):
+        if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
+            return "Something is wrong with your user name or password"
+        elif err.errno == errorcode.ER_BAD_DB_ERROR:
+            return "Database does not exist"
+        return str(err)
+
+    def is_full_scan(self, plan):
+        """Tell whether a row of EXPLAIN output is a full table scan"""
+        return plan.get("type") == "ALL"
+
+
+class SQLiteBackend:
+    """SQLite database file opened in-process, in WAL mode.
+
+    An in-memory database (path ":memory:") lives in a single
+    connection, so it has a single holder at a time: the pool has one
+    connection and everyone else waits until it is released (a second
+    session opened by the same thread would wait forever).
+    """
+
+    name = "sqlite"
+    schema = SQLITE_SCHEMA
+    migrations = SQLITE_MIGRATIONS
+    explain = "explain query plan "
+    Error = sqlite3.Error
+
+    def __init__(self, config):
+        self.path = config["path"]
+        self.shared_cnx = None
+        if self.path == ":memory:":
+            self.pool = ConnectionPool(self.connect, sqlite3.Error, size=1)
+        else:
+            self.pool = ConnectionPool(self.connect, sqlite3.Error)
+
+    def connect(self):
+        if self.path == ":memory:":
+            # every connection would get its own empty database;
+            # the pool hands this one to a single holder at a time
+            if self.shared_cnx is None:
+                self.shared_cnx = self.open()
+            return self.shared_cnx
+        return self.open()
+
+    def open(self):
+        cnx = sqlite3.connect(
+            self.path, check_same_thread=False,
+            cached_statements=SQLITE_CACHED_STATEMENTS)
+        cnx.execute("pragma journal_mode = wal")
+        cnx.execute("pragma synchronous = normal")
+        return cnx
+
+    def acquire(self):
+        return self.pool.acquire()
+
+    def release(self, cnx):
+        self.pool.release(cnx)
+
+    def cursor(self, cnx):
+        return SQLiteCursor(cnx.cursor())
+
+    def describe_error(self, err):
+        return "Cannot open {}: {}".format(self.path, err)
+
+    def is_full_scan(self, plan):
+        """Tell whether a row of EXPLAIN QUERY PLAN output
+        is a full table scan
+        """
+        detail = plan.get("detail", "")
+        # "SCAN n CONSTANT ROWS" is the values of a multi-row insert
+        return (detail.startswith("SCAN") and "USING" not in detail
+                and not detail.endswith("CONSTANT ROWS"))
+
+
+class SQLiteCursor:
+    """sqlite3 cursor accepting the MySQL flavoured queries
+    of RSDBConnection
+    """
+
+    translated = {}
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    @classmethod
+    def translate(cls, query):
+        if query not in cls.translated:
+            if len(cls.translated) > 1024:
+                cls.translated.clear()
+            translated = query
+            for pattern, replacement in SQLITE_TRANSLATIONS:
+                translated = pattern.sub(replacement, translated)
+            cls.translated[query] = translated
+        return cls.translated[query]
+
+    def execute(self, query, params=()):
+        self.cursor.execute(self.translate(query), tuple(params))
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchmany(self, size=1):
+        return self.cursor.fetchmany(size)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    def close(self):
+        self.cursor.close()
+
+
+def get_backend(config):
+    """Return the backend shared by everyone using given config"""
+    key = tuple(sorted(config.items()))
+    with BACKENDS_LOCK:
+        if key not in BACKENDS:
+            config = dict(config)
+            backend = config.pop("backend", "mysql")
+            if backend == "sqlite":
+                BACKENDS[key] = SQLiteBackend(config)
+            elif backend == "mysql":
+                BACKENDS[key] = MySQLBackend(config)
+            else:
+                raise ValueError("Unknown backend: {}".format(backend))
+        return BACKENDS[key]
@@ -4,39 +4,36 @@
 """System evaluation"""
 
 import csv
-import os
+import getopt
 import sys
 
-from scikits.crab.models import MatrixPreferenceDataModel
-from scikits.crab.metrics import pearson_correlation
-from scikits.crab.similarities import UserSimilarity
-from scikits.crab.recommenders.knn import UserBasedRecommender
-
+from game_catalog import get_game_catalog
+from group_aggregation import RATING_STRATEGIES, STRATEGY_NAMES, merge
+from model_snapshot import get_recommender
+from recommenders import DEFAULT_ENGINE, ENGINES
 from rs_db_connection import RSDBConnection
 
 
-def avg(data_list):
-    """Return average of given list of numbers
-    """
-    return sum(data_list) / len(data_list)
-
-
-def merge(data, merge_fun):
-    """Merge data (ratings or recommendations)
-    using given strategy (merge function)
-    """
-    return {
-        game_id: merge_fun(game_data.values())
-        for game_id, game_data in data.iteritems()}
+# Recommendation engine, one of recommenders.ENGINES (see --engine)
+ENGINE = DEFAULT_ENGINE
+# Aggregation strategies evaluated (the columns of eval/*.tsv);
+# --all-strategies evaluates every registered one
+EVAL_STRATEGIES = ["avg", "max", "min"]
 
 
-def merge_users(db_conn_conf, group_user_id, ratings, merge_fun):
-    """Merge users using given strategy (merge function)
+def recommend_merged_users(db_conn_conf, ratings, strategy, numplayers):
+    """Return recommendation of games numplayers can play
+    for a virtual group user merged from users' ratings
+    using given aggregation strategy;
+    nothing is written to the database
     """
-    individual_ratings = merge(ratings, merge_fun)
+    group_ratings = merge(ratings, strategy)
     db_conn = RSDBConnection(db_conn_conf)
-    db_conn.insert_user_ratings(group_user_id, individual_ratings)
+    recommender = get_recommender(db_conn, ENGINE)
     db_conn.finalize()
+    return recommender.recommend_ratings(
+        group_ratings.keys(), group_ratings.values(),
+        filters=[get_game_catalog(db_conn_conf).playable_by(numplayers)])
 
 
 def format_data(raw_data):
@@ -65,123 +62,53 @@ def get_users_ratings_dict(db_conn_conf, user_ids):
 def get_users_recommendations_dict(db_conn_conf, user_ids):
     """Create dict with recommendations for given users
     """
-    db_conn = RSDBConnection(db_conn_conf)
-    raw_recommendations = {
-        user_id: read_recommendation_from_file(
-            db_conn_conf,
-            db_conn.get_user_name(user_id))
-        for user_id in user_ids}
-    db_conn.finalize()
-    return format_data(raw_recommendations), len(user_ids)
+    return (format_data(full_recommendations(db_conn_conf, user_ids)),
+            len(user_ids))
 
 
-def build_recommender(data):
-    """Create recommender system
+def full_recommendations(db_conn_conf, user_ids):
+    """Return recommendations of all games for given users by user id
     """
-    print "Building the model..."
-    model = MatrixPreferenceDataModel(data)
-    print "Building the similarity..."
-    similarity = UserSimilarity(model, pearson_correlation)
-    print "Building the recommender..."
-    return UserBasedRecommender(
-        model, similarity, with_preference=True)
-
-
-def gen_individual_recommendation(db_conn_conf, user_name):
-    """Generate recommendation for single user
-    """
-    rec_file = open('recommendations/' + user_name, 'w+')
-
     db_conn = RSDBConnection(db_conn_conf)
-    user_id = db_conn.get_user_id(user_name)
-    data = db_conn.get_data_for_rs()
+    recommender = get_recommender(db_conn, ENGINE)
     db_conn.finalize()
-
-    recommender = build_recommender(data)
-    print "Recommending items for user:", user_name
-    recommendation = recommender.recommend(user_id)
-    # recommendation = [(1, 1.0)]
-    for game_id, prob in recommendation:
-        rec_file.write('{};{}\n'.format(game_id, prob))
-
-    rec_file.close()
-    return recommendation
-
-
-def check_file(file_name):
-    """Check if file with given name already exists
-    """
-    try:
-        return os.stat(file_name).st_size > 0
-    except OSError:
-        return False
+    return dict(recommender.recommend_all(user_ids))
 
 
-def read_recommendation_from_file(db_conn_conf, user_name):
-    """Get data from file with recommendations
+def gen_and_print_recommendation(db_conn_conf, group_name, recommendation):
+    """Function for saving group recommendation
     """
-    recommendation = []
-    recommendation_file_name = 'recommendations/' + user_name
-    if check_file(recommendation_file_name):
-        with open(recommendation_file_name, 'r') as rec_file:
-            for line in rec_file:
-                game_id, prob = line.split(';')
-                recommendation.append((int(game_id), float(prob)))
-    else:
-        recommendation = gen_individual_recommendation(db_conn_conf, user_name)
-    return recommendation
-
-
-def check_numplayers(db_conn_conf, num_players, game_id):
-    """Check if given number of players is relevant to given game
-    """
-    db_conn = RSDBConnection(db_conn_conf)
-    min_players, max_players = db_conn.get_numplayers(game_id)
-    db_conn.finalize()
-
-    return min_players <= num_players and num_players <= max_players
-
-
-def gen_and_print_recommendation(db_conn_conf, group_name, numplayers):
-    """Function for generating and printing recommendation
-    """
-    recommendation = read_recommendation_from_file(db_conn_conf, group_name)
+    game_names = get_game_catalog(db_conn_conf).names(
+        [game_id for game_id, _ in recommendation])
     with open('recommendations/'+group_name + '_result', 'w') as save_file:
-        for game_id, prob in recommendation:
-            if check_numplayers(db_conn_conf, numplayers, game_id):
-                rsdbc = RSDBConnection()
-                game = rsdbc.get_game_name(game_id)
-                rsdbc.finalize()
-                save_file.write('{};{}\n'.format(prob, game))
+        for (game_id, prob), game in zip(recommendation, game_names):
+            save_file.write('{};{}\n'.format(prob, game))
     return recommendation
 
 
-def recommend_merge_users(merge_fun):
+def recommend_merge_users(strategy):
     """Return function that makes recommendation
     using merge-user strategy
-    and a given merging function
+    and a given aggregation strategy
     """
     def recommend_fun(db_conn_conf, user_ids, group_name):
         ratings, num_players = get_users_ratings_dict(db_conn_conf, user_ids)
-
-        db_conn = RSDBConnection(db_conn_conf)
-        full_group_name = 'group_' + merge_fun.__name__ + '_' + group_name
-        group_user_id = db_conn.add_user(full_group_name)
-        db_conn.finalize()
-
-        merge_users(db_conn_conf, group_user_id, ratings, merge_fun)
-        return gen_and_print_recommendation(db_conn_conf, full_group_name, num_players)
+        full_group_name = 'group_' + strategy + '_' + group_name
+        recommendation = recommend_merged_users(
+            db_conn_conf, ratings, strategy, num_players)
+        return gen_and_print_recommendation(
+            db_conn_conf, full_group_name, recommendation)
     return recommend_fun
 
 
-def recommend_merge_recommendations(merge_fun):
+def recommend_merge_recommendations(strategy):
     """Return function that makes recommendation
     using merge-recommendations strategy
-    and a given merging function
+    and a given aggregation strategy
     """
     def recommend_fun(db_conn_conf, user_ids, group_name):
         recommendations, num_players = get_users_recommendations_dict(db_conn_conf, user_ids)
-        return merge(recommendations, merge_fun)
+        return merge(recommendations, strategy)
     return recommend_fun
 
 
@@ -191,16 +118,15 @@ def get_user_ratings(user_id):
     def resulting_fun(db_conn_conf, user_ids, group_name):
         db_conn = RSDBConnection(db_conn_conf)
         ratings = db_conn.get_user_ratings(user_id)
-        recommendations = read_recommendation_from_file(
-            db_conn_conf,
-            db_conn.get_user_name(user_id))
         db_conn.finalize()
-        return ratings + recommendations
+        return ratings + full_recommendations(
+            db_conn_conf, [user_id])[user_id]
     return resulting_fun
 
 
-def main(number_of_groups, max_group_size=4):
+def main(number_of_groups, max_group_size=4, strategies=EVAL_STRATEGIES):
     """Evaluate the system on a given number of random groups
+    using given aggregation strategies
     """
     db_conn_conf = {
         "user": "madzia",
@@ -208,14 +134,13 @@ def main(number_of_groups, max_group_size=4):
         "database": "bgg",
     }
 
+    user_strategies = [
+        strategy for strategy in strategies if strategy in RATING_STRATEGIES]
     recommendation_functions = [
-        recommend_merge_users(avg),
-        recommend_merge_users(max),
-        recommend_merge_users(min),
-        recommend_merge_recommendations(avg),
-        recommend_merge_recommendations(max),
-        recommend_merge_recommendations(min),
-    ]
+        recommend_merge_users(strategy)
+        for strategy in user_strategies] + [
+        recommend_merge_recommendations(strategy)
+        for strategy in strategies]
 
     user_groups = []
     db_conn = RSDBConnection(db_conn_conf)
@@ -254,17 +179,21 @@ def main(number_of_groups, max_group_size=4):
         with open('eval/' + group_name + '.tsv', 'wb') as eval_results_file:
             writer = csv.writer(eval_results_file, delimiter='\t')
             headings = ['game_id'] + user_names + [
-                'merge_usr_avg',
-                'merge_usr_max',
-                'merge_usr_min',
-                'merge_rec_avg',
-                'merge_rec_max',
-                'merge_rec_min',
-            ]
+                'merge_usr_' + strategy for strategy in user_strategies] + [
+                'merge_rec_' + strategy for strategy in strategies]
             writer.writerow(headings)
             for game_id, results in sorted(results_dict.items()):
                 writer.writerow([game_id] + results)
 
 
 if __name__ == "__main__":
-    main(int(sys.argv[1]))
+    opts, args = getopt.getopt(
+        sys.argv[1:], "", ["engine=", "all-strategies"])
+    opts = dict(opts)
+    ENGINE = opts.get("--engine", ENGINE)
+    if ENGINE not in ENGINES:
+        sys.exit("Unknown engine: " + ENGINE)
+    if "--all-strategies" in opts:
+        main(int(args[0]), strategies=STRATEGY_NAMES)
+    else:
+        main(int(args[0]))
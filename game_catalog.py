@@ -0,0 +1,127 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Game metadata kept in memory"""
+
+import time
+
+import numpy as np
+
+from rs_db_connection import MYSQL_CONNECTION_DEFAULT_CONFIG, RSDBConnection
+
+
+# How often (in seconds) the catalog checks whether the games table changed
+CATALOG_CHECK_EVERY = 60
+# Numbers of players the player-count index covers (larger ones
+# are looked up in minplayers and maxplayers)
+PLAYER_INDEX_SIZE = 20
+
+GAME_CATALOGS = {}
+
+
+class GameCatalog:
+    """Names, player counts and average ratings of all games,
+    loaded with a single query and kept in arrays sorted by game id.
+    All lookups take lists (or arrays) of game ids.
+    """
+
+    def __init__(self, db_conn_conf=MYSQL_CONNECTION_DEFAULT_CONFIG,
+                 check_every=CATALOG_CHECK_EVERY):
+        self.db_conn_conf = db_conn_conf
+        self.check_every = check_every
+        self.fingerprint = None
+        self.checked_at = 0
+        self.refresh()
+
+    def refresh(self, force=False):
+        """Reload the catalog if the games table changed"""
+        if not force and time.time() - self.checked_at < self.check_every:
+            return
+        with RSDBConnection(self.db_conn_conf) as db_conn:
+            fingerprint = db_conn.get_games_fingerprint()
+            if force or fingerprint != self.fingerprint:
+                self.load(db_conn.get_games_metadata())
+        self.fingerprint = fingerprint
+        self.checked_at = time.time()
+
+    def load(self, rows):
+        """Build the arrays from rows returned by get_games_metadata.
+        Metadata arrays get one extra entry at the end describing
+        an unknown game, which is what position -1 points at.
+        """
+        count = len(rows) + 1
+        self.ids = np.empty(count - 1, dtype=np.int32)
+        self.minplayers = np.zeros(count, dtype=np.int16)
+        self.maxplayers = np.zeros(count, dtype=np.int16)
+        self.bestnumplayers = np.zeros(count, dtype=np.int16)
+        self.avgrating = np.empty(count, dtype=np.float32)
+        self.game_names = np.empty(count, dtype=object)
+        self.avgrating[-1] = np.nan
+        for i, (game_id, name, minplayers, maxplayers,
+                bestnumplayers, avgrating) in enumerate(rows):
+            self.ids[i] = game_id
+            self.game_names[i] = (name or u'').encode('utf-8')
+            self.minplayers[i] = minplayers or 0
+            self.maxplayers[i] = maxplayers or 0
+            self.bestnumplayers[i] = bestnumplayers or 0
+            self.avgrating[i] = np.nan if avgrating is None else avgrating
+        self.index_players()
+
+    def index_players(self):
+        """Build the player-count index: row n of playable_at tells
+        which games (by position) n players can play, row n of best_at
+        which games are best with n players
+        """
+        counts = np.arange(PLAYER_INDEX_SIZE + 1)[:, np.newaxis]
+        self.playable_at = ((self.minplayers <= counts)
+                            & (counts <= self.maxplayers))
+        self.playable_at[0] = False
+        self.best_at = self.bestnumplayers == counts
+        self.best_at[0] = False
+
+    def positions(self, game_ids):
+        """Return positions of given games in the arrays, -1 for unknown ones
+        """
+        game_ids = np.asarray(game_ids, dtype=np.int64)
+        self.refresh()
+        positions = np.searchsorted(self.ids, game_ids)
+        found = positions < len(self.ids)
+        found[found] = self.ids[positions[found]] == game_ids[found]
+        return np.where(found, positions, -1)
+
+    def names(self, game_ids):
+        """Return a list of names of given games (None for unknown ones)"""
+        positions = self.positions(game_ids)
+        return list(self.game_names[positions])
+
+    def players_mask(self, numplayers, best=False):
+        """Return a boolean array telling which games (by position)
+        numplayers players can play, or are best with if best is set
+        """
+        if 0 < numplayers <= PLAYER_INDEX_SIZE:
+            return (self.best_at if best else self.playable_at)[numplayers]
+        if best:
+            return (self.bestnumplayers == numplayers) & (numplayers > 0)
+        return ((self.minplayers <= numplayers)
+                & (numplayers <= self.maxplayers) & (numplayers > 0))
+
+    def playable(self, game_ids, numplayers, best=False):
+        """Return a boolean array telling which of given games
+        can be played by numplayers players (are best with them)
+        """
+        positions = self.positions(game_ids)
+        return self.players_mask(numplayers, best)[positions]
+
+    def playable_by(self, numplayers, best=False):
+        """Return a filter for Recommender.recommend
+        accepting games playable by numplayers players (best with them)
+        """
+        return lambda game_ids: self.playable(game_ids, numplayers, best)
+
+
+def get_game_catalog(db_conn_conf=MYSQL_CONNECTION_DEFAULT_CONFIG):
+    """Return the catalog shared by everyone using given config"""
+    key = tuple(sorted(db_conn_conf.items()))
+    if key not in GAME_CATALOGS:
+        GAME_CATALOGS[key] = GameCatalog(db_conn_conf)
+    return GAME_CATALOGS[key]
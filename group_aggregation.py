@@ -0,0 +1,143 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Aggregation of group members' scores into group scores
+
+Scores of a group are a members x games float array together with
+a boolean array of the same shape telling which scores are present.
+A strategy takes both and returns one score per game, NaN for games
+no member has a score for. Strategies are registered by name in
+STRATEGIES; new ones are added with the strategy decorator.
+"""
+
+import numpy as np
+
+
+# Strategies by name, see strategy
+STRATEGIES = {}
+# Names of strategies in the order they were registered (for menus)
+STRATEGY_NAMES = []
+# Names of strategies giving scores on the scale of members' scores,
+# so that the group scores can be used as ratings of a group user
+RATING_STRATEGIES = []
+# Average without misery drops games some member scores below this
+MISERY_THRESHOLD = 4.0
+
+
+def strategy(name, rating_scale=True):
+    """Return decorator registering an aggregation strategy under name"""
+    def register(function):
+        STRATEGIES[name] = function
+        STRATEGY_NAMES.append(name)
+        if rating_scale:
+            RATING_STRATEGIES.append(name)
+        return function
+    return register
+
+
+def filled(scores, present, value):
+    """Return scores with the missing ones replaced by value"""
+    return np.where(present, scores, value)
+
+
+def nobody_scored(present):
+    """Return which games have no score of any member"""
+    return ~present.any(axis=0)
+
+
+@strategy("min")
+def least_misery(scores, present):
+    """The lowest score of a member (least misery)"""
+    group = filled(scores, present, np.inf).min(axis=0)
+    group[nobody_scored(present)] = np.nan
+    return group
+
+
+@strategy("max")
+def most_pleasure(scores, present):
+    """The highest score of a member (most pleasure)"""
+    group = filled(scores, present, -np.inf).max(axis=0)
+    group[nobody_scored(present)] = np.nan
+    return group
+
+
+@strategy("avg")
+def average(scores, present):
+    """Average of scores of members who have one"""
+    counts = present.sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return filled(scores, present, 0.0).sum(axis=0) / counts
+
+
+@strategy("borda", rating_scale=False)
+def borda_count(scores, present):
+    """Sum of members' Borda points: a member gives every game as many
+    points as the number of games they score lower, ties share the points
+    """
+    rows = np.arange(scores.shape[0])[:, np.newaxis]
+    positions = np.arange(scores.shape[1])
+    # missing scores sort first and are tied, so every member's present
+    # scores take positions from the number of missing ones on
+    order = np.argsort(filled(scores, present, -np.inf), axis=1)
+    ranked = scores[rows, order]
+    ranked[~present[rows, order]] = -np.inf
+    starts = np.ones(ranked.shape, dtype=bool)
+    starts[:, 1:] = ranked[:, 1:] != ranked[:, :-1]
+    ends = np.ones(ranked.shape, dtype=bool)
+    ends[:, :-1] = starts[:, 1:]
+    firsts = np.maximum.accumulate(np.where(starts, positions, 0), axis=1)
+    lasts = np.minimum.accumulate(
+        np.where(ends, positions, len(positions))[:, ::-1], axis=1)[:, ::-1]
+    points = np.empty(scores.shape)
+    points[rows, order] = 0.5 * (firsts + lasts)
+    points -= (~present).sum(axis=1)[:, np.newaxis]
+    group = filled(points, present, 0.0).sum(axis=0)
+    group[nobody_scored(present)] = np.nan
+    return group
+
+
+@strategy("multiplicative", rating_scale=False)
+def multiplicative(scores, present):
+    """Product of scores of members who have one"""
+    group = filled(scores, present, 1.0).prod(axis=0)
+    group[nobody_scored(present)] = np.nan
+    return group
+
+
+@strategy("avg_without_misery")
+def average_without_misery(scores, present):
+    """Average of scores of members who have one, NaN for games
+    some member scores below MISERY_THRESHOLD
+    """
+    group = average(scores, present)
+    group[(present & (scores < MISERY_THRESHOLD)).any(axis=0)] = np.nan
+    return group
+
+
+def score_matrix(data):
+    """Return (members, game ids, scores, present) out of data:
+    {game_id: {member: score}} as ratings and recommendations of a group
+    are kept; members and game ids are sorted
+    """
+    members = sorted(set(
+        member for game_data in data.itervalues() for member in game_data))
+    game_ids = np.array(sorted(data), dtype=np.int64)
+    rows = {member: row for row, member in enumerate(members)}
+    scores = np.zeros((len(members), len(game_ids)))
+    present = np.zeros(scores.shape, dtype=bool)
+    for column, game_id in enumerate(game_ids):
+        for member, score in data[game_id].iteritems():
+            scores[rows[member], column] = score
+            present[rows[member], column] = True
+    return members, game_ids, scores, present
+
+
+def merge(data, name):
+    """Return {game_id: group score} out of data: {game_id: {member: score}}
+    using strategy of given name; games the strategy gives no score
+    are left out
+    """
+    _, game_ids, scores, present = score_matrix(data)
+    group = STRATEGIES[name](scores, present)
+    scored = ~np.isnan(group)
+    return dict(zip(game_ids[scored].tolist(), group[scored].tolist()))
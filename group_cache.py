@@ -0,0 +1,73 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Group recommendations kept in memory, so that asking again
+for the same group does not compute them again
+"""
+
+from collections import OrderedDict
+
+
+# Group results kept at most; the least recently used go first
+GROUP_CACHE_SIZE = 256
+
+
+class GroupCache:
+    """LRU cache of group results. A result is keyed by the set
+    of member ids (in any order, under any group name), the aggregation
+    strategy, the number of players and the version of the model
+    it was computed with. Results of a member are dropped when the
+    member's ratings change (see model_snapshot.update_user).
+    """
+
+    def __init__(self, size=GROUP_CACHE_SIZE):
+        self.size = size
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(member_ids, strategy, numplayers, version):
+        return (tuple(sorted(set(int(member) for member in member_ids))),
+                strategy, numplayers, version)
+
+    def get(self, key):
+        """Return the result stored under key, None if there is none"""
+        try:
+            result = self.results.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.results[key] = result
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        self.results.pop(key, None)
+        self.results[key] = result
+        while len(self.results) > self.size:
+            self.results.popitem(last=False)
+
+    def get_or_compute(self, member_ids, strategy, numplayers, version,
+                       compute):
+        """Return the cached result of the group,
+        calling compute() and caching what it returns on a miss
+        """
+        key = self.key(member_ids, strategy, numplayers, version)
+        result = self.get(key)
+        if result is None:
+            result = compute()
+            self.put(key, result)
+        return result
+
+    def invalidate_member(self, member_id):
+        """Drop results of all groups the member is in"""
+        for key in [key for key in self.results if member_id in key[0]]:
+            del self.results[key]
+
+    def clear(self):
+        self.results.clear()
+
+
+# The cache shared by everyone in the process
+GROUP_RESULTS = GroupCache()
@@ -1,16 +1,25 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-"""Parse data from BoardGameGeek XMLs and insert them to MySQL database"""
+"""Parse data from BoardGameGeek XMLs and insert them to MySQL database
 
-from rs_db_connection import RSDBConnection
+With --incremental only files changed since the previous incremental run
+are parsed, and the games and ratings they describe are updated.
+"""
+
+import sys
+
+from rs_db_connection import IngestManifest, RSDBConnection
 
 
 if __name__ == "__main__":
+    manifest = None
+    if "--incremental" in sys.argv[1:]:
+        manifest = IngestManifest()
     rsdbc = RSDBConnection()
     rsdbc.create_tables()
-    rsdbc.process_games("dane")
+    rsdbc.process_games("dane", manifest=manifest)
     # rsdbc.show_games()
-    rsdbc.process_users("users")
+    rsdbc.process_users("users", manifest=manifest)
     rsdbc.finalize()
     print "Done."
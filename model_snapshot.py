@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Recommender models saved to disk, so that they are rebuilt
+only when the ratings change
+"""
+
+from group_cache import GROUP_RESULTS
+from ratings_matrix import load_ratings, ratings_arrays, ratings_from_arrays
+from recommendation_store import get_store
+from recommenders import DEFAULT_ENGINE, ENGINES, build_recommender
+import snapshot
+
+
+# Where models are saved, by engine name
+MODEL_SNAPSHOT_FILE = "recommendations/{}.model"
+# Bump whenever the saved arrays or their meaning change
+MODEL_FORMAT_VERSION = 2
+
+# (ratings watermark, recommender, model version) by path
+LOADED_MODELS = {}
+
+
+def save_model(path, recommender, watermark):
+    """Save the recommender together with the ratings watermark
+    it was built for
+    """
+    arrays = recommender.model_arrays()
+    arrays.update(ratings_arrays(recommender.ratings))
+    snapshot.save_arrays(path, arrays, {
+        "version": MODEL_FORMAT_VERSION,
+        "engine": recommender.engine,
+        "watermark": watermark,
+        "params": recommender.model_params(),
+    })
+
+
+def load_model(path, watermark=None, engine=None):
+    """Return the recommender saved in path with its arrays memory-mapped,
+    or None if there is no usable snapshot (missing, saved by another
+    version or engine, or built for other ratings than watermark describes)
+    """
+    try:
+        arrays, meta = snapshot.load_arrays(path)
+    except (IOError, ValueError):
+        return None
+    if meta.get("version") != MODEL_FORMAT_VERSION:
+        return None
+    if watermark is not None and meta.get("watermark") != watermark:
+        return None
+    if engine is not None and meta.get("engine") != engine:
+        return None
+    return ENGINES[meta["engine"]].from_model(
+        ratings_from_arrays(arrays), arrays, meta["params"])
+
+
+def get_recommender(db_conn, engine=DEFAULT_ENGINE, path=None):
+    """Return a recommender of given engine for the current ratings:
+    the one already loaded, the one saved in path
+    (MODEL_SNAPSHOT_FILE of the engine by default),
+    or (when ratings changed since) a new one, which is saved in path
+    and starts from the saved one when the engine can do that
+    """
+    path = path or MODEL_SNAPSHOT_FILE.format(engine)
+    watermark = db_conn.get_ratings_watermark()
+    loaded = LOADED_MODELS.get(path)
+    if loaded is not None and loaded[0] == watermark:
+        return loaded[1]
+    recommender = load_model(path, watermark, engine)
+    if recommender is None:
+        recommender = build_recommender(
+            load_ratings(db_conn), engine,
+            loaded[1] if loaded else load_model(path, engine=engine))
+        save_model(path, recommender, watermark)
+    LOADED_MODELS[path] = (
+        watermark, recommender, (engine, tuple(watermark)))
+    return recommender
+
+
+def model_version(engine=DEFAULT_ENGINE, path=None):
+    """Return version of the recommender get_recommender returned
+    last time, None if there is none. The version changes whenever
+    the model is loaded, built or fitted again, not when a user
+    is only updated.
+    """
+    loaded = LOADED_MODELS.get(path or MODEL_SNAPSHOT_FILE.format(engine))
+    return loaded[2] if loaded else None
+
+
+def update_user(db_conn, user_id, engine=DEFAULT_ENGINE, path=None,
+                watermark=None):
+    """Bring the loaded recommender up to date with current ratings
+    of the user, without rebuilding it. Saves it again when the update
+    recomputed all neighbors. Nothing happens if no recommender
+    is loaded, or if it was built for other ratings than watermark
+    (read before the user's ratings changed) describes;
+    get_recommender builds a current one later.
+    Games becoming eligible for all users with these ratings
+    are only taken into account when all neighbors are recomputed.
+    Cached group results and the stored recommendation
+    of the user are dropped.
+    """
+    GROUP_RESULTS.invalidate_member(user_id)
+    get_store().discard(user_id)
+    path = path or MODEL_SNAPSHOT_FILE.format(engine)
+    loaded = LOADED_MODELS.get(path)
+    if loaded is None or watermark not in (None, loaded[0]):
+        return
+    recommender, version = loaded[1], loaded[2]
+    ratings = db_conn.get_user_ratings_for_rs(user_id)
+    reconciled = recommender.update_user(
+        user_id,
+        [game_id for game_id, _ in ratings],
+        [rating for _, rating in ratings])
+    watermark = db_conn.get_ratings_watermark()
+    if reconciled:
+        save_model(path, recommender, watermark)
+        version = (engine, tuple(watermark))
+    LOADED_MODELS[path] = (watermark, recommender, version)
+
+
+def insert_user_ratings(db_conn, user_id, ratings, engine=DEFAULT_ENGINE,
+                        path=None):
+    """Insert ratings of the user (a dict) into the database
+    and update the loaded recommender (if any) for them
+    """
+    watermark = db_conn.get_ratings_watermark()
+    db_conn.insert_user_ratings(user_id, ratings)
+    update_user(db_conn, user_id, engine, path, watermark)
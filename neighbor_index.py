@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Approximate nearest neighbors of users
+
+Users are hashed with random-projection LSH over their mean-centered
+rating vectors: every table takes the signs of num_bits random
+projections as a bucket code. Users sharing a bucket (or, with
+multiprobe, a bucket differing by one bit) in any table are candidates,
+and only candidates are compared with the exact Pearson correlation.
+Buckets are kept as sorted arrays, so finding them is a binary search.
+"""
+
+import numpy as np
+
+# recommenders imports this module for its engine using the index
+import recommenders
+
+
+# Number of hash tables; more tables find more neighbors, slower
+LSH_TABLES = 8
+# Bits of a bucket code; None chooses them from LSH_BUCKET_SIZE
+LSH_BITS = None
+# Average number of users per bucket when LSH_BITS is None
+LSH_BUCKET_SIZE = 64
+# Probe also the buckets whose code differs by one bit
+LSH_MULTIPROBE = True
+
+
+def center_rows(matrix):
+    """Return a float32 copy of the sparse matrix with mean of every row
+    subtracted from its stored values
+    """
+    centered = matrix.astype(np.float32)
+    counts = np.diff(centered.indptr)
+    sums = np.add.reduceat(centered.data, centered.indptr[:-1][counts > 0])
+    means = np.zeros(len(counts), dtype=np.float32)
+    means[counts > 0] = sums / counts[counts > 0]
+    centered.data -= np.repeat(means, counts)
+    return centered
+
+
+def bits_for(num_users, bucket_size=LSH_BUCKET_SIZE):
+    """Return number of code bits giving buckets of about bucket_size users"""
+    return int(max(1, min(62, np.log2(max(num_users, 1) / float(bucket_size)))))
+
+
+class RandomProjectionIndex:
+    """Random-projection LSH index over rows of a RatingsMatrix"""
+
+    def __init__(self, ratings, num_tables=LSH_TABLES, num_bits=LSH_BITS,
+                 multiprobe=LSH_MULTIPROBE, seed=0):
+        matrix = ratings.matrix
+        self.num_tables = num_tables
+        self.num_bits = num_bits or bits_for(matrix.shape[0])
+        self.multiprobe = multiprobe
+        rng = np.random.RandomState(seed)
+        self.planes = rng.standard_normal(
+            (matrix.shape[1], num_tables * self.num_bits)).astype(np.float32)
+        self.terms = recommenders.pearson_terms(matrix)
+        self.codes = self.hash_rows(matrix)
+        self.tables = [self.build_table(self.codes[:, table])
+                       for table in range(num_tables)]
+        flips = np.left_shift(1, np.arange(self.num_bits, dtype=np.int64))
+        if multiprobe:
+            self.flips = np.append(0, flips)
+        else:
+            self.flips = np.zeros(1, dtype=np.int64)
+
+    def hash_rows(self, matrix):
+        """Return bucket codes of rating rows as a rows x tables array"""
+        projected = np.asarray(center_rows(matrix).dot(self.planes))
+        signs = (projected > 0).reshape(
+            (matrix.shape[0], self.num_tables, self.num_bits))
+        powers = np.left_shift(1, np.arange(self.num_bits, dtype=np.int64))
+        return signs.dot(powers)
+
+    @staticmethod
+    def build_table(codes):
+        """Return (bucket codes, bucket starts, bucket ends, rows)
+        with rows sorted by their code
+        """
+        rows = np.argsort(codes, kind="mergesort")
+        keys, starts = np.unique(codes[rows], return_index=True)
+        ends = np.append(starts[1:], len(rows))
+        return keys, starts, ends, rows.astype(np.int32)
+
+    def candidates(self, codes):
+        """Return rows sharing a probed bucket with given codes
+        (one per table)
+        """
+        found = []
+        for (keys, starts, ends, rows), code in zip(self.tables, codes):
+            probes = np.bitwise_xor(code, self.flips)
+            positions = np.searchsorted(keys, probes)
+            inside = positions < len(keys)
+            positions, probes = positions[inside], probes[inside]
+            for position in positions[keys[positions] == probes]:
+                found.append(rows[starts[position]:ends[position]])
+        if not found:
+            return np.empty(0, dtype=np.int32)
+        return np.unique(np.concatenate(found))
+
+    def query(self, row, size, minimal_similarity=None):
+        """Return (rows, similarities) of at most size users most similar
+        to the user in given row, best first, found among the candidates
+        """
+        candidates = self.candidates(self.codes[row])
+        candidates = candidates[candidates != row]
+        similarity = recommenders.pearson_block(
+            self.terms, row, row + 1, candidates)[0]
+        keep = ~np.isnan(similarity)
+        if minimal_similarity is not None:
+            keep[keep] = similarity[keep] >= minimal_similarity
+        candidates, similarity = candidates[keep], similarity[keep]
+        if size and size < len(candidates):
+            best = np.argpartition(-similarity, size - 1)[:size]
+            candidates, similarity = candidates[best], similarity[best]
+        order = np.argsort(-similarity, kind="mergesort")
+        return candidates[order], similarity[order]
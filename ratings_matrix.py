@@ -0,0 +1,221 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Ratings kept as a sparse user x game matrix"""
+
+import sys
+
+import numpy as np
+from scipy import sparse
+
+from rs_db_connection import RATINGS_CHUNK_SIZE, RSDBConnection
+import snapshot
+
+
+# Where ratings are exported to and loaded from
+RATINGS_SNAPSHOT_FILE = "recommendations/ratings.snapshot"
+
+
+class RatingsMatrix:
+    """Ratings as a float32 CSR matrix.
+    Row i holds ratings of user user_ids[i], column j of game game_ids[j];
+    both id arrays are sorted int32 arrays.
+    """
+
+    def __init__(self, matrix, user_ids, game_ids):
+        self.matrix = matrix
+        self.user_ids = user_ids
+        self.game_ids = game_ids
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    def index_of(self, ids, wanted):
+        """Return positions of wanted ids in sorted ids, -1 if missing"""
+        wanted = np.asarray(wanted, dtype=np.int64)
+        positions = np.searchsorted(ids, wanted)
+        found = positions < len(ids)
+        found[found] = ids[positions[found]] == wanted[found]
+        return np.where(found, positions, -1)
+
+    def user_index(self, user_id):
+        """Return row of the user, None if the user has no ratings"""
+        index = self.index_of(self.user_ids, [user_id])[0]
+        return None if index < 0 else int(index)
+
+    def game_indices(self, game_ids):
+        return self.index_of(self.game_ids, game_ids)
+
+    def with_user_ratings(self, user_id, game_ids, ratings):
+        """Return (RatingsMatrix with ratings of the user replaced
+        by given ones, row of the user, whether the row is a new one).
+        Games nobody rated before get new columns.
+        """
+        game_ids = np.asarray(game_ids, dtype=np.int32)
+        order = np.argsort(game_ids)
+        game_ids = game_ids[order]
+        ratings = np.asarray(ratings, dtype=np.float32)[order]
+        all_game_ids, moved = self.game_ids, None
+        if not np.in1d(game_ids, self.game_ids).all():
+            all_game_ids = np.union1d(self.game_ids, game_ids).astype(
+                np.int32)
+            moved = np.searchsorted(all_game_ids, self.game_ids)
+        row = self.user_index(user_id)
+        added = row is None
+        if added:
+            row = int(np.searchsorted(self.user_ids, user_id))
+            user_ids = np.insert(self.user_ids, row, user_id)
+        else:
+            user_ids = self.user_ids
+        matrix = replace_row(
+            self.matrix, row, np.searchsorted(all_game_ids, game_ids),
+            ratings, added, moved, len(all_game_ids))
+        return RatingsMatrix(matrix, user_ids, all_game_ids), row, added
+
+
+def replace_row(matrix, row, indices, data, added=False, moved=None,
+                num_columns=None):
+    """Return a copy of the CSR matrix with the row replaced by one
+    holding data in given sorted columns (inserted before the row
+    when added). moved maps old columns to those of a matrix
+    with num_columns columns when columns are added.
+    The arrays are only spliced, not sorted again.
+    """
+    start = matrix.indptr[row]
+    end = start if added else matrix.indptr[row + 1]
+    old_indices = matrix.indices
+    if moved is not None:
+        old_indices = moved[old_indices]
+    if added:
+        indptr = np.insert(matrix.indptr, row, start)
+    else:
+        indptr = matrix.indptr.copy()
+    indptr[row + 1:] += len(indices) - (end - start)
+    return sparse.csr_matrix((
+        np.concatenate((matrix.data[:start],
+                        np.asarray(data, dtype=matrix.data.dtype),
+                        matrix.data[end:])),
+        np.concatenate((old_indices[:start], indices,
+                        old_indices[end:])).astype(matrix.indices.dtype),
+        indptr),
+        shape=(len(indptr) - 1, num_columns or matrix.shape[1]))
+
+
+def from_sorted_arrays(users, games, ratings):
+    """Build RatingsMatrix from parallel arrays sorted by user id"""
+    if len(users):
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(users)) + 1))
+    else:
+        starts = np.empty(0, dtype=np.int64)
+    user_ids = users[starts]
+    indptr = np.append(starts, len(users))
+    game_ids, indices = np.unique(games, return_inverse=True)
+    matrix = sparse.csr_matrix(
+        (ratings.astype(np.float32),
+         indices.astype(np.int32),
+         indptr.astype(np.int32)),
+        shape=(len(user_ids), len(game_ids)))
+    return RatingsMatrix(
+        matrix, user_ids.astype(np.int32), game_ids.astype(np.int32))
+
+
+def load_ratings_matrix(db_conn, chunk_size=RATINGS_CHUNK_SIZE):
+    """Stream ratings from the database straight into a RatingsMatrix,
+    holding at most chunk_size rows as Python objects at a time;
+    the rows are sorted by user and game once they are arrays
+    """
+    users = [np.empty(0, dtype=np.int32)]
+    games = [np.empty(0, dtype=np.int32)]
+    ratings = [np.empty(0, dtype=np.float32)]
+    for rows in db_conn.iter_ratings_for_rs(chunk_size):
+        chunk = np.array(rows, dtype=np.float64)
+        users.append(chunk[:, 0].astype(np.int32))
+        games.append(chunk[:, 1].astype(np.int32))
+        ratings.append(chunk[:, 2].astype(np.float32))
+    users = np.concatenate(users)
+    games = np.concatenate(games)
+    order = np.lexsort((games, users))
+    return from_sorted_arrays(
+        users[order], games[order], np.concatenate(ratings)[order])
+
+
+def ratings_arrays(ratings):
+    """Return the arrays RatingsMatrix consists of, by name"""
+    return {
+        "user_ids": ratings.user_ids,
+        "game_ids": ratings.game_ids,
+        "ratings_indptr": ratings.matrix.indptr,
+        "ratings_indices": ratings.matrix.indices,
+        "ratings_data": ratings.matrix.data,
+    }
+
+
+def ratings_from_arrays(arrays):
+    """Return RatingsMatrix using (not copying) arrays
+    named like ratings_arrays names them
+    """
+    matrix = sparse.csr_matrix(
+        (arrays["ratings_data"], arrays["ratings_indices"],
+         arrays["ratings_indptr"]),
+        shape=(len(arrays["user_ids"]), len(arrays["game_ids"])),
+        copy=False)
+    return RatingsMatrix(matrix, arrays["user_ids"], arrays["game_ids"])
+
+
+def save_ratings_snapshot(path, ratings, meta):
+    """Write ratings to a snapshot file: CSR offsets, int32 game columns,
+    float32 ratings and the sorted int32 user and game ids
+    """
+    snapshot.save_arrays(path, ratings_arrays(ratings), meta)
+
+
+def load_ratings_snapshot(path):
+    """Return (RatingsMatrix memory-mapping the snapshot in path, its meta);
+    raise IOError if there is no valid snapshot
+    """
+    arrays, meta = snapshot.load_arrays(path)
+    return ratings_from_arrays(arrays), meta
+
+
+def snapshot_meta(db_conn):
+    """Return what tells whether a snapshot matches the database"""
+    return {
+        "watermark": db_conn.get_ratings_watermark(),
+        "eligible_min_ratings": db_conn.eligible_min_ratings,
+    }
+
+
+def export_ratings(db_conn, path=RATINGS_SNAPSHOT_FILE):
+    """Write ratings from the database to a snapshot, return them"""
+    meta = snapshot_meta(db_conn)
+    ratings = load_ratings_matrix(db_conn)
+    save_ratings_snapshot(path, ratings, meta)
+    return ratings
+
+
+def load_ratings(db_conn=None, path=RATINGS_SNAPSHOT_FILE):
+    """Return ratings memory-mapped from the snapshot in path when it
+    matches the database (always, without db_conn); otherwise load them
+    from the database and export them to path for the next time
+    """
+    try:
+        ratings, meta = load_ratings_snapshot(path)
+    except (IOError, ValueError):
+        if db_conn is None:
+            raise
+    else:
+        if db_conn is None or meta == snapshot_meta(db_conn):
+            return ratings
+    return export_ratings(db_conn, path)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] != ["export"]:
+        sys.exit("Usage: ratings_matrix.py export [path]")
+    rsdbc = RSDBConnection()
+    path = sys.argv[2] if len(sys.argv) > 2 else RATINGS_SNAPSHOT_FILE
+    ratings = export_ratings(rsdbc, path)
+    rsdbc.finalize()
+    print "Exported {} ratings of {} users".format(
+        ratings.matrix.nnz, ratings.shape[0])
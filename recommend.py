@@ -3,38 +3,23 @@
 
 """Collect data from MySQL database and use them"""
 
-import itertools
-import operator
-import os
-
-from scikits.crab.models import MatrixPreferenceDataModel
-from scikits.crab.metrics import pearson_correlation
-from scikits.crab.similarities import UserSimilarity
-from scikits.crab.recommenders.knn import UserBasedRecommender
-
-import numpy as np
-
+import getopt
+import sys
+
+from game_catalog import get_game_catalog
+from group_aggregation import (
+    RATING_STRATEGIES, STRATEGIES, STRATEGY_NAMES, merge, score_matrix)
+from group_cache import GROUP_RESULTS
+from model_snapshot import get_recommender, insert_user_ratings, model_version
+from recommendation_store import STORE_GAMES_PER_USER, get_store
+from recommenders import DEFAULT_ENGINE, ENGINES, best_games
 from rs_db_connection import RSDBConnection
 
 
-def download_data(db_conn):
-    """Download data
-    """
-    data = db_conn.get_data_for_rs()
-    # data = dict(itertools.islice(data.iteritems(), 190, 300))
-    return data
-
-
-def build_recommender(data):
-    """Create recommender system
-    """
-    print "Building the model..."
-    model = MatrixPreferenceDataModel(data)
-    print "Building the similarity..."
-    similarity = UserSimilarity(model, pearson_correlation)
-    print "Building the recommender..."
-    return UserBasedRecommender(
-        model, similarity, with_preference=True)
+# Recommendation engine, one of recommenders.ENGINES (see --engine)
+ENGINE = DEFAULT_ENGINE
+# Games shown (and saved) for an individual or group recommendation
+RECOMMENDATION_SIZE = 50
 
 
 def collect_user_ratings(db_conn, user_id):
@@ -68,53 +53,31 @@ def add_new_user():
             "This name isn't available. Choose another one: ")
         user_id = rsdbc.add_user(user)
     ratings = collect_user_ratings(rsdbc, user_id)
-    rsdbc.insert_user_ratings(user_id, ratings)
+    insert_user_ratings(rsdbc, user_id, ratings, ENGINE)
     rsdbc.finalize()
 
-def generate_individual_recommendation(user_name):
-    """Generate recommendation for single user
+def generate_individual_recommendation(rsdbc, user_id):
+    """Generate recommendation for single user and store it
     """
-    rec_file = open('recommendations/'+user_name, 'w+')
-    rsdbc = RSDBConnection()
-    user_id = rsdbc.get_user_id(user_name)
-    data = download_data(rsdbc)
-    recommender = build_recommender(data)
+    recommender = get_recommender(rsdbc, ENGINE)
     print "Recommending items..."
-    recommendation = recommender.recommend(user_id)
-    #print "Recommendations:\nprob\tgame"
-    for game_id, prob in recommendation:
-        #game = rsdbc.get_game_name(game_id)
-        #print '{:.3f}\t{}'.format(prob, game)
-        rec_file.write('{};{}\n'.format(game_id, prob))
-    rsdbc.finalize()
-    rec_file.close()
+    recommendation = recommender.recommend(user_id, STORE_GAMES_PER_USER)
+    get_store().put(user_id, recommendation, model_version(ENGINE))
     return recommendation
 
-def check_recommendation_file(filename):
-    """Check if file with given username recommendations already exists
+def read_recommendation(user_name, how_many=None):
+    """Get recommendation of the user from the recommendation store,
+    generate it if there is none for the current model;
+    return at most how_many best games (all stored by default)
     """
-    try:
-        if os.stat(filename).st_size > 0:
-           return True
-        else:
-           return False
-    except OSError:
-        return False
-
-def read_recommendation_from_file(user_name):
-    """Get data from file with recommendations
-    """
-    recommendation = []
-    if check_recommendation_file('recommendations/'+user_name):
-        with open('recommendations/'+user_name, 'r') as rec_file:
-            for line in rec_file:
-                game_id, prob = line.split(';')
-                game_id = int(game_id)
-                prob = float(prob)
-                recommendation.append((game_id, prob))
-    else:
-        recommendation = generate_individual_recommendation(user_name)
-    return recommendation
+    rsdbc = RSDBConnection()
+    user_id = rsdbc.get_user_id(user_name)
+    get_recommender(rsdbc, ENGINE)
+    recommendation = get_store().get(user_id, model_version(ENGINE))
+    if recommendation is None:
+        recommendation = generate_individual_recommendation(rsdbc, user_id)
+    rsdbc.finalize()
+    return recommendation[:how_many]
 
 def get_user_ratings_for_game():
     """Function for getting ratings of chosen game_name
@@ -178,23 +141,23 @@ def show_user_ratings():
     user_name = raw_input("Please enter your username\n")
     user_id = rsdbc.get_user_id(user_name)
     ratings = rsdbc.get_user_ratings(user_id)
+    rsdbc.finalize()
+    # the catalog takes a connection of its own
+    game_names = get_game_catalog().names([elem[0] for elem in ratings])
     print '\n\nrating\t\t game'
-    for elem in ratings:
-        game_name = rsdbc.get_game_name(elem[0])
+    for elem, game_name in zip(ratings, game_names):
         print '{1}\t\t {0}'.format(game_name, elem[1])
     print "\n\n"
-    rsdbc.finalize()
 
-def create_dict_with_group_ratings():
-    """Function that creates a dict with user ratings from our group
+def choose_group_members():
+    """Ask for user names of group members,
+    return {user_id: user_name}
     """
     rsdbc = RSDBConnection()
     menu = {}
     menu['1'] = 'Add user to group'
     menu['0'] = 'End'
-    user_ids = []
-    ratings = {}
-    game_ratings = {}
+    members = {}
     while(True):
         options = menu.keys()
         options.sort()
@@ -203,161 +166,118 @@ def create_dict_with_group_ratings():
         selection = raw_input("Please select: ")
         if selection == '1':
             user_name = raw_input("Please give the user name of existing user: ")
-            user_id = rsdbc.get_user_id(user_name)
-            user_ids.append(user_id)
+            members[rsdbc.get_user_id(user_name)] = user_name
         elif selection == '0':
             break
         else:
             print 'Wrong option!\n'
-        for user_id in user_ids:
-            rating = rsdbc.get_user_ratings(user_id)
-            ratings[user_id] = rating
     rsdbc.finalize()
+    return members
 
-    for user_id, game_dict in ratings.iteritems():
-        for game_id, rating in game_dict:
+def create_dict_with_group_ratings(user_ids):
+    """Function that creates a dict with ratings of given users
+    """
+    rsdbc = RSDBConnection()
+    game_ratings = {}
+    for user_id in user_ids:
+        for game_id, rating in rsdbc.get_user_ratings(user_id):
             if game_id in game_ratings:
                 game_ratings[game_id] [user_id] = rating
             else:
                 game_ratings[game_id] = {user_id:rating}
-    return game_ratings, len(user_ids)
-
-def create_dict_with_group_recommendations():
-    """Function that creates a dict with user ratings from our group
-    """
-    menu = {}
-    menu['1'] = 'Add user to group'
-    menu['0'] = 'End'
-    user_names = []
-    game_ratings = {}
-    while(True):
-        options = menu.keys()
-        options.sort()
-        for entry in options:
-            print entry, menu[entry]
-        selection = raw_input("Please select: ")
-        if selection == '1':
-            user_name = raw_input("Please give the user name of existing user: ")
-            user_names.append(user_name)
-        elif selection == '0':
-            break
-        else:
-            print 'Wrong option!\n'
-        for user_name in user_names:
-            print 'reading from file ', user_name
-            single_recommendation = read_recommendation_from_file(user_name)
-            for game_id, prob in single_recommendation:
-                if game_id in game_ratings:
-                    game_ratings[game_id] [user_name] = prob
-                else:
-                    game_ratings[game_id] = {user_name:prob}
-    return game_ratings, len(user_names)
+    rsdbc.finalize()
+    return game_ratings
 
-def merge_user_least_misery(user_id, ratings):
-    """For each game get minimum from users' from group rating
+def create_dict_with_group_recommendations(members):
+    """Function that creates a dict with recommendations of given members
     """
     rsdbc = RSDBConnection()
-    individual_ratings = {}
-    for game_id, game_ratings in ratings.iteritems():
-        user_id_min_rating = min(game_ratings.iteritems(), key=operator.itemgetter(1))[0]
-        min_rating = game_ratings[user_id_min_rating]
-        individual_ratings[game_id] = min_rating
-    print individual_ratings
-    rsdbc.insert_user_ratings(user_id, individual_ratings)
+    recommender = get_recommender(rsdbc, ENGINE)
     rsdbc.finalize()
+    game_ratings = {}
+    for user_id, single_recommendation in recommender.recommend_all(
+            members.keys()):
+        user_name = members[user_id]
+        for game_id, prob in single_recommendation:
+            if game_id in game_ratings:
+                game_ratings[game_id] [user_name] = prob
+            else:
+                game_ratings[game_id] = {user_name:prob}
+    return game_ratings
 
-def merge_user_max(user_id, ratings):
-    """For each game get maximum from users' from group rating
+def group_name(members):
+    """Return name of the group of members ({user_id: user_name})
+    used in names of files with its recommendations
     """
-    rsdbc = RSDBConnection()
-    individual_ratings = {}
-    for game_id, game_ratings in ratings.iteritems():
-        user_id_max_rating = max(game_ratings.iteritems(), key=operator.itemgetter(1))[0]
-        max_rating = game_ratings[user_id_max_rating]
-        individual_ratings[game_id] = max_rating
-    print individual_ratings
-    rsdbc.insert_user_ratings(user_id, individual_ratings)
-    rsdbc.finalize()
+    return "_".join(sorted(members.values()))
 
-def merge_user_avg(user_id, ratings):
-    """For each game get average from users' from group rating
+def current_model_version():
+    """Return version of the current model, building it if needed
     """
     rsdbc = RSDBConnection()
-    individual_ratings = {}
-    for game_id, game_ratings in ratings.iteritems():
-        ratings = [game_ratings[i] for i in game_ratings]
-        avg_rating = sum(ratings)/len(ratings)
-        individual_ratings[game_id] = avg_rating
-    print individual_ratings
-    rsdbc.insert_user_ratings(user_id, individual_ratings)
+    get_recommender(rsdbc, ENGINE)
     rsdbc.finalize()
+    return model_version(ENGINE)
 
-def merge_rec_least_misery(ratings):
-    """For each game get minimum from users' from group rating
+def recommend_merged_users(user_ids, strategy, numplayers):
+    """Recommend games numplayers can play to a virtual group user
+    rating games the way given aggregation strategy merges users' ratings.
+    The group user is only scored, nothing is written to the database.
+    Results are cached for the group.
     """
-    individual_ratings = {}
-    group_name = ''
-    for game_id, game_ratings in ratings.iteritems():
-        user_id_min_rating = min(game_ratings.iteritems(), key=operator.itemgetter(1))[0]
-        group_name = "_".join(game_ratings.keys())
-        min_rating = game_ratings[user_id_min_rating]
-        individual_ratings[game_id] = min_rating
-    sorted_recommendations = sorted(individual_ratings.items(), key=operator.itemgetter(1), reverse=True)
-    print sorted_recommendations
-    with open('recommendations/'+group_name+'_min', 'w') as save_file:
+    def recommend_fun():
+        group_ratings = merge(
+            create_dict_with_group_ratings(user_ids), strategy)
         rsdbc = RSDBConnection()
-        for game_id, recommendation in sorted_recommendations:
-            game_name = rsdbc.get_game_name(game_id)
-            save_file.write('{};{}\n'.format(recommendation, game_name))
+        recommender = get_recommender(rsdbc, ENGINE)
         rsdbc.finalize()
-
-def merge_rec_max(ratings):
-    """For each game get maximum from users' from group rating
+        return recommender.recommend_ratings(
+            group_ratings.keys(), group_ratings.values(),
+            RECOMMENDATION_SIZE,
+            filters=[get_game_catalog().playable_by(numplayers)])
+    return GROUP_RESULTS.get_or_compute(
+        user_ids, ('users', strategy), numplayers,
+        current_model_version(), recommend_fun)
+
+def merge_recommendations(members, strategy):
+    """Merge recommendations of members ({user_id: user_name})
+    using given aggregation strategy and save RECOMMENDATION_SIZE
+    best games; results are cached for the group
     """
-    individual_ratings = {}
-    group_name = ''
-    for game_id, game_ratings in ratings.iteritems():
-        user_id_max_rating = max(game_ratings.iteritems(), key=operator.itemgetter(1))[0]
-        group_name = "_".join(game_ratings.keys())
-        max_rating = game_ratings[user_id_max_rating]
-        individual_ratings[game_id] = max_rating
-    sorted_recommendations = sorted(individual_ratings.items(), key=operator.itemgetter(1), reverse=True)
+    def merge_fun():
+        ratings = create_dict_with_group_recommendations(members)
+        _, game_ids, scores, present = score_matrix(ratings)
+        group = STRATEGIES[strategy](scores, present)
+        best = best_games(group, RECOMMENDATION_SIZE)
+        return zip(game_ids[best].tolist(), group[best].tolist())
+    sorted_recommendations = GROUP_RESULTS.get_or_compute(
+        members, ('recommendations', strategy), None,
+        current_model_version(), merge_fun)
     print sorted_recommendations
-    with open('recommendations/'+group_name+'_max', 'w') as save_file:
-        rsdbc = RSDBConnection()
-        for game_id, recommendation in sorted_recommendations:
-            game_name = rsdbc.get_game_name(game_id)
+    game_names = get_game_catalog().names(
+        [game_id for game_id, _ in sorted_recommendations])
+    with open('recommendations/'+group_name(members)+'_'+strategy,
+              'w') as save_file:
+        for (game_id, recommendation), game_name in zip(
+                sorted_recommendations, game_names):
             save_file.write('{};{}\n'.format(recommendation, game_name))
-        rsdbc.finalize()
 
-def merge_rec_avg(ratings):
-    """For each game get average from users' from group rating
+def choose_strategy(names, label):
+    """Display menu of given aggregation strategies,
+    return the chosen one (None for Back)
     """
-    individual_ratings = {}
-    group_name = ''
-    for game_id, game_ratings in ratings.iteritems():
-        ratings = [game_ratings[i] for i in game_ratings]
-        group_name = "_".join(game_ratings.keys())
-        avg_rating = sum(ratings)/len(ratings)
-        individual_ratings[game_id] = avg_rating
-    sorted_recommendations = sorted(individual_ratings.items(), key=operator.itemgetter(1), reverse=True)
-    print sorted_recommendations
-    with open('recommendations/'+group_name+'_avg', 'w') as save_file:
-        rsdbc = RSDBConnection()
-        for game_id, recommendation in sorted_recommendations:
-            game_name = rsdbc.get_game_name(game_id)
-            save_file.write('{};{}\n'.format(recommendation, game_name))
-        rsdbc.finalize()
-
-def check_numplayers(numplayers, game_id):
-    rsdbc = RSDBConnection()
-    minplayers, maxplayers = rsdbc.get_numplayers(game_id)
-    print 'gameid ', game_id
-    print 'numplayers ', numplayers
-    print 'minplayers ', minplayers
-    print 'maxplayers ', maxplayers
-    rsdbc.finalize()
-    return minplayers <= numplayers and numplayers <= maxplayers
+    menu = {'0': 'Back'}
+    for number, name in enumerate(names, 1):
+        menu[str(number)] = '{}{} strategy '.format(label, name)
+    while True:
+        for entry in sorted(menu, key=int):
+            print entry, menu[entry]
+        selection = raw_input("Please select: ")
+        if selection == '0':
+            return None
+        elif selection in menu:
+            return names[int(selection) - 1]
+        print 'Wrong option!\n'
 
 def make_group_recommendation():
     """Display menu for choose of method of group recommendation.
@@ -375,84 +295,35 @@ def make_group_recommendation():
             print entry, menu_rec[entry]
         selection = raw_input("Please select: ")
         if selection == '2':
-            group_ratings, numplayers = create_dict_with_group_ratings()
-            group_name = raw_input("Please provide a name for your group: ")
-
-            rsdbc = RSDBConnection()
-            user_id = rsdbc.add_user(group_name)
-            # while not user_id:
-            #     group_name = raw_input(
-            #         "This name isn't available. Choose another one: ")
-            #     user_id = rsdbc.add_user(group_name)
-            rsdbc.finalize()
-
-            menu_user_approach = {}
-            menu_user_approach['0'] = 'Back'
-            menu_user_approach['1'] = 'User Minimum strategy '
-            menu_user_approach['2'] = 'User Maximum strategy '
-            menu_user_approach['3'] = 'User Avg strategy '
-            options2 = menu_user_approach.keys()
-            options2.sort()
-            for entry2 in options2:
-                print entry2, menu_user_approach[entry2]
-            selection2 = raw_input("Please select: ")
-            if selection2 == '0':
+            members = choose_group_members()
+            strategy = choose_strategy(RATING_STRATEGIES, 'User ')
+            if strategy is None:
                 break
-            elif selection2 == '1':
-                merge_user_least_misery(user_id, group_ratings)
-                generate_and_print_recommendation(group_name, numplayers)
-            elif selection2 == '2':
-                merge_user_max(user_id, group_ratings)
-                generate_and_print_recommendation(group_name, numplayers)
-            elif selection2 == '3':
-                merge_user_avg(user_id, group_ratings)
-                generate_and_print_recommendation(group_name, numplayers)
-            else:
-                print 'Wrong option!\n'
+            recommendation = recommend_merged_users(
+                members.keys(), strategy, len(members))
+            generate_and_print_recommendation(
+                group_name(members), recommendation)
         elif selection == '0':
             break
         elif selection == '1':
-            group_ratings, numplayers = create_dict_with_group_recommendations()
-            menu_rec_approach = {}
-            menu_rec_approach['0'] = 'Back'
-            menu_rec_approach['1'] = 'Minimum strategy '
-            menu_rec_approach['2'] = 'Maximum strategy '
-            menu_rec_approach['3'] = 'Avg strategy '
-            options3 = menu_rec_approach.keys()
-            options3.sort()
-            for entry3 in options3:
-                print entry3, menu_rec_approach[entry3]
-            selection3 = raw_input("Please select: ")
-            if selection3 == '0':
+            members = choose_group_members()
+            strategy = choose_strategy(STRATEGY_NAMES, '')
+            if strategy is None:
                 break
-            elif selection3 == '1':
-                merge_rec_least_misery(group_ratings)
-            elif selection3 == '2':
-                merge_rec_max(group_ratings)
-            elif selection3 == '3':
-                merge_rec_avg(group_ratings)
-            else:
-                print 'Wrong option!\n'
+            merge_recommendations(members, strategy)
         else:
             print 'Wrong option!\n'
 
-def generate_and_print_recommendation(group_name, numplayers):
-    """Function for generating and printing recommendation
+def generate_and_print_recommendation(group_name, recommendation):
+    """Function for printing and saving group recommendation
     """
     print "\nI'M RECOMMENDING\n"
-    recommendation = read_recommendation_from_file(group_name)
-    print 'mam rekomendacje\n\n'
+    game_names = get_game_catalog().names(
+        [game_id for game_id, _ in recommendation])
     with open('recommendations/'+group_name + '_result', 'w') as save_file:
-        for game_id, prob in recommendation:
-            print 'jestem w forze\n numplayers '
-            print numplayers
-            if check_numplayers(numplayers, game_id):
-                print 'sprawdzam numplayers \n'
-                rsdbc = RSDBConnection()
-                game = rsdbc.get_game_name(game_id)
-                rsdbc.finalize()
-                print '{:.3f}\t{}'.format(prob, game)
-                save_file.write('{} ;{}\n'.format(prob, game))
+        for (game_id, prob), game in zip(recommendation, game_names):
+            print '{:.3f}\t{}'.format(prob, game)
+            save_file.write('{} ;{}\n'.format(prob, game))
 
 def main():
     """Do the stuff
@@ -478,18 +349,18 @@ def main():
             user_id, ratings = get_user_ratings_for_game()
 
             rsdbc = RSDBConnection()
-            rsdbc.insert_user_ratings(user_id, ratings)
+            insert_user_ratings(rsdbc, user_id, ratings, ENGINE)
             rsdbc.finalize()
 
         elif selection == '2':
             user_name = raw_input("Give user name for counting recommendation: ")
-            recommendation = read_recommendation_from_file(user_name)
+            recommendation = read_recommendation(
+                user_name, RECOMMENDATION_SIZE)
 
-            rsdbc = RSDBConnection()
-            for game_id, prob in recommendation[:50]:
-                 game = rsdbc.get_game_name(game_id)
+            game_names = get_game_catalog().names(
+                [game_id for game_id, _ in recommendation])
+            for (game_id, prob), game in zip(recommendation, game_names):
                  print '{:.3f}\t{}'.format(prob, game)
-            rsdbc.finalize()
 
         elif selection == '3':
             make_group_recommendation()
@@ -503,4 +374,8 @@ def main():
 
 
 if __name__ == "__main__":
+    opts, _ = getopt.getopt(sys.argv[1:], "", ["engine="])
+    ENGINE = dict(opts).get("--engine", ENGINE)
+    if ENGINE not in ENGINES:
+        sys.exit("Unknown engine: " + ENGINE)
     main()
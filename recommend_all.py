@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Write recommendations of many users in one pass
+
+Usage: ./recommend_all.py [-n HOW_MANY] [-m MEMORY_MB] [-e ENGINE] [user ...]
+Without user names recommendations of all users are written.
+They go to the recommendation store recommend.py reads them from,
+stamped with the version of the model they were made with.
+"""
+
+import getopt
+import sys
+import time
+
+from model_snapshot import get_recommender, model_version
+from recommendation_store import STORE_GAMES_PER_USER, get_store
+from recommenders import BATCH_MEMORY_BUDGET, DEFAULT_ENGINE, ENGINES
+from rs_db_connection import RSDBConnection
+
+
+def write_recommendations(recommender, store, version, user_ids=None,
+                          how_many=STORE_GAMES_PER_USER,
+                          memory_budget=BATCH_MEMORY_BUDGET):
+    """Store recommendations of given users (all by default)
+    made with given model version, return number of users stored
+    """
+    written = 0
+    for user_id, recommendation in recommender.recommend_all(
+            user_ids, how_many, memory_budget):
+        store.put(user_id, recommendation, version, flush=False)
+        written += 1
+    store.flush()
+    return written
+
+
+def main(argv):
+    opts, names = getopt.getopt(argv, "n:m:e:")
+    opts = dict(opts)
+    engine = opts.get("-e", DEFAULT_ENGINE)
+    if engine not in ENGINES:
+        sys.exit("Unknown engine: " + engine)
+    how_many = STORE_GAMES_PER_USER
+    if "-n" in opts:
+        how_many = min(int(opts["-n"]), how_many)
+    memory_budget = BATCH_MEMORY_BUDGET
+    if "-m" in opts:
+        memory_budget = int(opts["-m"]) * 1024 * 1024
+
+    rsdbc = RSDBConnection()
+    recommender = get_recommender(rsdbc, engine)
+    user_names = rsdbc.get_user_names()
+    rsdbc.finalize()
+
+    user_ids = None
+    if names:
+        ids = {name.lower(): user_id
+               for user_id, name in user_names.iteritems()}
+        unknown = [name for name in names if name.lower() not in ids]
+        if unknown:
+            sys.exit("Unknown users: " + ", ".join(unknown))
+        user_ids = [ids[name.lower()] for name in names]
+    start = time.time()
+    written = write_recommendations(
+        recommender, get_store(), model_version(engine), user_ids,
+        how_many, memory_budget)
+    print "Wrote {} recommendations in {:.1f}s".format(
+        written, time.time() - start)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
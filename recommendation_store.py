@@ -0,0 +1,220 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Recommendations of individual users kept in a single file
+
+Layout: 8 byte magic, 4 byte little-endian number of games per record,
+padding up to HEADER_SIZE bytes, then fixed-width records (slots),
+one per user: user id (0 for a free slot), stamp of the model version
+the recommendation was made with, time it was written, number of games,
+then game ids and scores of at most games_per_user best games.
+The file is memory-mapped; finding a user's slot is a dict lookup,
+so reading a recommendation parses nothing.
+
+A recommendation is served only for the model version it was stamped
+with and for ttl seconds. The file grows up to max_bytes; after that
+the least recently written recommendations (those of other model
+versions first) make room for new ones.
+The store expects one writing process at a time.
+
+Only the best games are kept, so recommendations merged into group ones
+(which need scores of all games) do not come from the store.
+"""
+
+import hashlib
+import os
+import struct
+import time
+
+import numpy as np
+
+
+MAGIC = b"BGRECS01"
+HEADER_SIZE = 64
+# Where recommendations are stored
+STORE_FILE = "recommendations/store.bin"
+# Best games kept for every user
+STORE_GAMES_PER_USER = 1000
+# Size the store file may grow to
+STORE_MAX_BYTES = 256 * 1024 * 1024
+# Seconds a recommendation is served for
+STORE_TTL = 7 * 24 * 3600
+# Slots the file grows by at least
+STORE_GROW_SLOTS = 64
+# Part of the slots freed at once when the file is full
+STORE_EVICT_FRACTION = 0.125
+
+STORES = {}
+
+
+def record_dtype(games_per_user):
+    return np.dtype([
+        ("user_id", "<i8"),
+        ("stamp", "<i8"),
+        ("written", "<f8"),
+        ("count", "<i4"),
+        ("padding", "<i4"),
+        ("game_ids", "<i4", (games_per_user,)),
+        ("scores", "<f4", (games_per_user,)),
+    ])
+
+
+def version_stamp(version):
+    """Return a positive int64 identifying the model version,
+    0 (matching nothing stored) for None
+    """
+    if version is None:
+        return 0
+    return int(hashlib.md5(repr(version)).hexdigest()[:15], 16) or 1
+
+
+class RecommendationStore:
+    """Recommendations by user id in a memory-mapped file of slots"""
+
+    def __init__(self, path=STORE_FILE, games_per_user=STORE_GAMES_PER_USER,
+                 max_bytes=STORE_MAX_BYTES, ttl=STORE_TTL):
+        self.path = path
+        self.games_per_user = games_per_user
+        self.ttl = ttl
+        self.dtype = record_dtype(games_per_user)
+        self.max_slots = max(
+            1, (max_bytes - HEADER_SIZE) // self.dtype.itemsize)
+        self.open()
+
+    def header(self):
+        header = MAGIC + struct.pack("<I", self.games_per_user)
+        return header + b"\0" * (HEADER_SIZE - len(header))
+
+    def open(self):
+        """Map the store file; a missing one, or one written with another
+        number of games per user, is replaced by an empty store
+        """
+        try:
+            with open(self.path, "rb") as store_file:
+                header = store_file.read(HEADER_SIZE)
+        except IOError:
+            header = b""
+        if header != self.header():
+            with open(self.path, "wb") as store_file:
+                store_file.write(self.header())
+        size = os.path.getsize(self.path)
+        self.map_records((size - HEADER_SIZE) // self.dtype.itemsize)
+
+    def map_records(self, num_slots):
+        """Map num_slots slots and index the users in them"""
+        if num_slots:
+            self.records = np.memmap(
+                self.path, dtype=self.dtype, mode="r+", offset=HEADER_SIZE,
+                shape=(num_slots,))
+        else:
+            self.records = np.zeros(0, dtype=self.dtype)
+        user_ids = np.array(self.records["user_id"])
+        used = np.flatnonzero(user_ids)
+        self.slots = dict(zip(user_ids[used].tolist(), used.tolist()))
+        self.free = np.flatnonzero(user_ids == 0)[::-1].tolist()
+
+    def slot_of(self, user_id):
+        """Return slot of the user, None if the user has none"""
+        slot = self.slots.get(user_id)
+        if slot is not None and self.records["user_id"][slot] != user_id:
+            # another process reused the slot
+            self.open()
+            slot = self.slots.get(user_id)
+        return slot
+
+    def get(self, user_id, version):
+        """Return (game_id, score) pairs stored for the user,
+        None unless they were made with given model version
+        less than ttl seconds ago
+        """
+        slot = self.slot_of(user_id)
+        if slot is None:
+            return None
+        record = self.records[slot]
+        if (record["stamp"] != version_stamp(version)
+                or time.time() - record["written"] > self.ttl):
+            return None
+        count = record["count"]
+        return zip(record["game_ids"][:count].tolist(),
+                   record["scores"][:count].tolist())
+
+    def put(self, user_id, recommendation, version, flush=True):
+        """Store (game_id, score) pairs of the user made with given model
+        version, at most games_per_user of them (best first)
+        """
+        stamp = version_stamp(version)
+        slot = self.slot_of(user_id)
+        if slot is None:
+            slot = self.free_slot(stamp)
+        recommendation = recommendation[:self.games_per_user]
+        count = len(recommendation)
+        records = self.records
+        records["user_id"][slot] = 0
+        records["game_ids"][slot, :count] = [
+            game_id for game_id, _ in recommendation]
+        records["scores"][slot, :count] = [
+            score for _, score in recommendation]
+        records["count"][slot] = count
+        records["stamp"][slot] = stamp
+        records["written"][slot] = time.time()
+        records["user_id"][slot] = user_id
+        self.slots[user_id] = slot
+        if flush:
+            self.flush()
+
+    def free_slot(self, stamp):
+        """Return a free slot, growing the file or evicting
+        recommendations (not stamped with stamp first) if needed
+        """
+        while self.free:
+            slot = self.free.pop()
+            if self.records["user_id"][slot] == 0:
+                return slot
+        if len(self.records) < self.max_slots:
+            self.grow()
+        else:
+            self.evict(stamp)
+        return self.free_slot(stamp)
+
+    def grow(self):
+        num_slots = min(self.max_slots,
+                        max(2 * len(self.records),
+                            len(self.records) + STORE_GROW_SLOTS))
+        self.flush()
+        size = HEADER_SIZE + num_slots * self.dtype.itemsize
+        with open(self.path, "r+b") as store_file:
+            store_file.truncate(max(size, os.path.getsize(self.path)))
+        self.map_records(num_slots)
+
+    def evict(self, stamp):
+        """Free STORE_EVICT_FRACTION of the slots, least recently
+        written first; recommendations of other model versions go first
+        """
+        count = max(1, int(len(self.records) * STORE_EVICT_FRACTION))
+        written = np.where(self.records["stamp"] == stamp,
+                           self.records["written"], -np.inf)
+        evicted = np.argpartition(written, count - 1)[:count]
+        for user_id in self.records["user_id"][evicted].tolist():
+            self.slots.pop(user_id, None)
+        self.records["user_id"][evicted] = 0
+        self.free.extend(sorted(evicted.tolist(), reverse=True))
+
+    def discard(self, user_id):
+        """Remove the user's recommendation"""
+        slot = self.slot_of(user_id)
+        if slot is not None:
+            self.records["user_id"][slot] = 0
+            del self.slots[user_id]
+            self.free.append(slot)
+            self.flush()
+
+    def flush(self):
+        if isinstance(self.records, np.memmap):
+            self.records.flush()
+
+
+def get_store(path=STORE_FILE):
+    """Return the store in path shared by everyone in the process"""
+    if path not in STORES:
+        STORES[path] = RecommendationStore(path)
+    return STORES[path]
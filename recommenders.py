@@ -0,0 +1,885 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Collaborative filtering engines working on a RatingsMatrix"""
+
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+import sys
+import time
+
+import numpy as np
+from scipy import sparse
+
+import neighbor_index
+from ratings_matrix import replace_row
+
+
+# Number of most similar users kept for every user
+NEIGHBORHOOD_SIZE = 200
+# Number of most similar games kept for every game
+ITEM_NEIGHBORHOOD_SIZE = 50
+# Users (or games) with a lower similarity are never neighbors
+MINIMAL_SIMILARITY = 0.0
+# Memory the similarity computation may use for dense blocks,
+# all worker processes together
+SIMILARITY_MEMORY_BUDGET = 512 * 1024 * 1024
+# Processes computing similarity blocks, None means one per CPU
+SIMILARITY_PROCESSES = None
+# Latent factors of every user and game in the ALS engine
+ALS_FACTORS = 32
+# Regularization of ALS factors, multiplied by their number of ratings
+ALS_REGULARIZATION = 0.3
+# Alternating passes of an ALS fit, from scratch and from previous factors
+ALS_ITERATIONS = 15
+ALS_WARM_ITERATIONS = 5
+# Threads solving ALS factors, None means one per CPU
+ALS_THREADS = None
+# Incremental updates made before all neighbors are recomputed
+RECONCILE_EVERY = 100
+# Memory the batch mode may use for dense blocks of scores
+BATCH_MEMORY_BUDGET = 256 * 1024 * 1024
+
+
+def binarize(matrix):
+    """Return a copy of the sparse matrix with all stored values set to 1"""
+    binary = matrix.copy()
+    binary.data = np.ones_like(binary.data)
+    return binary
+
+
+def pearson_terms(ratings):
+    """Return matrices pearson_block works on: ratings, the rated mask
+    and squared ratings
+    """
+    r = ratings.astype(np.float64)
+    return r, binarize(r), r.multiply(r).tocsr()
+
+
+def pearson_block(terms, start, end, columns=None):
+    """Return Pearson correlations between users start..end-1
+    and all users (or only the given columns), each pair computed
+    over the games both of them rated, as a dense array
+    (nan where undefined)
+    """
+    r, b, r2 = terms
+    if columns is not None:
+        r, b, r2 = r[columns], b[columns], r2[columns]
+    return pearson_between(
+        (terms[0][start:end], terms[1][start:end], terms[2][start:end]),
+        (r, b, r2))
+
+
+def pearson_between(row_terms, terms):
+    """Return Pearson correlations between users of row_terms and users
+    of terms (both pearson_terms), like pearson_block.
+    All the sums are sparse matrix products.
+    """
+    def product(rows, others):
+        # only the few rows get transposed, not all users
+        return others.dot(rows.T).T.toarray()
+
+    rb, bb, r2b = row_terms
+    r, b, r2 = terms
+    n = product(bb, b)
+    sum_x = product(rb, b)
+    sum_y = product(bb, r)
+    sum_xy = product(rb, r)
+    sum_xx = product(r2b, b)
+    sum_yy = product(bb, r2)
+    numerator = n * sum_xy - sum_x * sum_y
+    denominator = (n * sum_xx - sum_x ** 2) * (n * sum_yy - sum_y ** 2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        similarity = numerator / np.sqrt(denominator)
+    similarity[~(denominator > 0)] = np.nan
+    return similarity
+
+
+def top_neighbors(similarity, start, size, minimal_similarity):
+    """Return (rows, columns, weights) of at most size best neighbors
+    of every row of a similarity block starting at row start
+    """
+    similarity = similarity.copy()
+    block_rows = np.arange(similarity.shape[0])
+    similarity[block_rows, block_rows + start] = np.nan
+    with np.errstate(invalid="ignore"):
+        similarity[~(similarity >= minimal_similarity)] = -np.inf
+    size = min(size or similarity.shape[1], similarity.shape[1])
+    if size < similarity.shape[1]:
+        best = np.argpartition(-similarity, size - 1, axis=1)[:, :size]
+    else:
+        best = np.tile(np.arange(similarity.shape[1]), (len(block_rows), 1))
+    weights = similarity[block_rows[:, None], best]
+    keep = np.isfinite(weights)
+    rows = np.repeat(block_rows + start, keep.sum(axis=1))
+    return rows, best[keep], weights[keep]
+
+
+def lowest_positions(indptr, data, rows):
+    """Return positions of the lowest value in each of given
+    non-empty rows of CSR arrays
+    """
+    if not len(rows):
+        return np.empty(0, dtype=np.intp)
+    lengths = indptr[rows + 1] - indptr[rows]
+    firsts = np.cumsum(lengths) - lengths
+    positions = np.arange(lengths.sum()) + np.repeat(
+        indptr[rows] - firsts, lengths)
+    values = data[positions]
+    segments = np.repeat(np.arange(len(rows)), lengths)
+    lowest = np.flatnonzero(
+        values == np.minimum.reduceat(values, firsts)[segments])
+    first = np.unique(segments[lowest], return_index=True)[1]
+    return positions[lowest[first]]
+
+
+# What worker processes of all_pairs_neighbors work on; set before
+# the pool starts, so that forked workers share it instead of copying
+SIMILARITY_JOB = {}
+
+
+def similarity_block_rows(num_rows, memory_budget, processes):
+    """Return how many rows a similarity block may have for all
+    processes together to stay within memory_budget bytes
+    """
+    # pearson_block holds about ten dense block x rows float64 arrays
+    return max(1, memory_budget // (processes * 80 * max(num_rows, 1)))
+
+
+def neighbors_of_block(start):
+    """Return (start, end, seconds, top_neighbors) of the block
+    of SIMILARITY_JOB starting at row start
+    """
+    began = time.time()
+    terms = SIMILARITY_JOB["terms"]
+    end = min(start + SIMILARITY_JOB["block_rows"], terms[0].shape[0])
+    block = top_neighbors(
+        pearson_block(terms, start, end), start,
+        SIMILARITY_JOB["size"], SIMILARITY_JOB["minimal_similarity"])
+    return start, end, time.time() - began, block
+
+
+def all_pairs_neighbors(matrix, size, minimal_similarity,
+                        memory_budget=SIMILARITY_MEMORY_BUDGET,
+                        processes=SIMILARITY_PROCESSES):
+    """Yield top_neighbors of all rows of the matrix, comparing every row
+    with all the others. Rows are split into blocks sized by memory_budget
+    and computed by a pool of processes; throughput of every block
+    is reported as it is done.
+    """
+    num_rows = matrix.shape[0]
+    processes = processes or cpu_count()
+    block_rows = similarity_block_rows(num_rows, memory_budget, processes)
+    starts = range(0, num_rows, block_rows)
+    SIMILARITY_JOB.update(
+        terms=pearson_terms(matrix), block_rows=block_rows,
+        size=size, minimal_similarity=minimal_similarity)
+    pool = None
+    if processes > 1 and len(starts) > 1:
+        pool = Pool(processes)
+        blocks = pool.imap_unordered(neighbors_of_block, starts)
+    else:
+        blocks = (neighbors_of_block(start) for start in starts)
+    try:
+        for done, (start, end, seconds, block) in enumerate(blocks, 1):
+            sys.stdout.write(
+                "\rSimilarity block {}/{} (rows {}-{}): {:.0f} rows/s".format(
+                    done, len(starts), start, end,
+                    (end - start) / max(seconds, 1e-6)))
+            sys.stdout.flush()
+            yield block
+        print
+        if pool is not None:
+            pool.close()
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+        SIMILARITY_JOB.clear()
+
+
+def neighbors_matrix(blocks, size):
+    """Return size x size CSR matrix of weights
+    from (rows, columns, weights) blocks
+    """
+    rows, columns, weights = [], [], []
+    for block in blocks:
+        rows.append(block[0])
+        columns.append(block[1])
+        weights.append(block[2])
+    if rows:
+        rows = np.concatenate(rows)
+        columns = np.concatenate(columns)
+        weights = np.concatenate(weights)
+    return sparse.csr_matrix(
+        (np.asarray(weights, dtype=np.float32), (rows, columns)),
+        shape=(size, size))
+
+
+def solve_factors(matrix, fixed, regularization, rows):
+    """Return regularized least-squares factors of given rows
+    of the centered ratings matrix, factors of its columns being fixed
+    """
+    size = fixed.shape[1]
+    grams = np.empty((len(rows), size, size))
+    targets = np.empty((len(rows), size))
+    counts = np.diff(matrix.indptr)[rows]
+    for position, row in enumerate(rows):
+        start, end = matrix.indptr[row], matrix.indptr[row + 1]
+        rated = fixed[matrix.indices[start:end]]
+        grams[position] = rated.T.dot(rated)
+        targets[position] = rated.T.dot(matrix.data[start:end])
+    # rows without ratings get zero factors
+    grams += np.eye(size) * (regularization * np.maximum(counts, 1))[
+        :, None, None]
+    return np.linalg.solve(grams, targets[:, :, None])[:, :, 0]
+
+
+def all_columns(columns):
+    """Return columns to index with, all of them for None"""
+    return slice(None) if columns is None else columns
+
+
+def best_games(scores, how_many=None):
+    """Return indices of at most how_many best scores (all by default),
+    best first, skipping nan
+    """
+    if how_many is not None and how_many <= 0:
+        return np.empty(0, dtype=np.intp)
+    candidates = np.flatnonzero(~np.isnan(scores))
+    if how_many is not None and how_many < len(candidates):
+        # like the full sort, ties go to the lower index
+        values = -scores[candidates]
+        kth = np.partition(values, how_many - 1)[how_many - 1]
+        better = candidates[values < kth]
+        tied = candidates[values == kth][:how_many - len(better)]
+        candidates = np.sort(np.concatenate((better, tied)))
+    return candidates[np.argsort(-scores[candidates], kind="mergesort")]
+
+
+class Recommender:
+    """What the engines share: ratings, incremental updates
+    and recommendations. An engine builds its model in fit,
+    keeps it current for a changed user in update_model,
+    and implements score_rows (users of the model) and score_ratings
+    (a user outside of it). model_arrays, model_params
+    and from_model let model_snapshot save and load the model.
+    """
+
+    def set_ratings(self, ratings):
+        """Use given RatingsMatrix from now on"""
+        self.ratings = ratings
+        self.rated = binarize(ratings.matrix)
+        self.game_counts = np.bincount(
+            ratings.matrix.indices, minlength=ratings.shape[1])
+        if ratings.matrix.nnz:
+            self.min_rating = ratings.matrix.data.min()
+            self.max_rating = ratings.matrix.data.max()
+
+    def update_user(self, user_id, game_ids, ratings):
+        """Replace ratings of the user (a new user is added)
+        and update only the part of the model the change touches.
+        Return True if the whole model was fitted again instead,
+        which happens every reconcile_every updates.
+        """
+        previous = self.ratings
+        ratings, row, _ = previous.with_user_ratings(
+            user_id, game_ids, ratings)
+        self.set_ratings(ratings)
+        self.updates += 1
+        if self.reconcile_every and self.updates >= self.reconcile_every:
+            self.fit()
+            return True
+        self.update_model(previous, row)
+        return False
+
+    def candidate_columns(self, exclude=None, min_ratings=None,
+                          filters=()):
+        """Return columns of games worth scoring, None meaning all:
+        not in exclude (game ids), rated at least min_ratings times,
+        and accepted by every filter (a function taking an array
+        of game ids and returning a boolean array)
+        """
+        if exclude is None and min_ratings is None and not filters:
+            return None
+        game_ids = self.ratings.game_ids
+        keep = np.ones(len(game_ids), dtype=bool)
+        if exclude is not None:
+            keep &= ~np.in1d(game_ids, np.asarray(list(exclude)))
+        if min_ratings is not None:
+            keep &= self.game_counts >= min_ratings
+        for accept in filters:
+            keep[keep] = accept(game_ids[keep])
+        return np.flatnonzero(keep)
+
+    def recommendation(self, scores, columns, how_many):
+        """Return (game_id, estimated rating) pairs of how_many
+        best of scores computed for given columns
+        """
+        order = best_games(scores, how_many)
+        positions = order if columns is None else columns[order]
+        return zip(self.ratings.game_ids[positions].tolist(),
+                   scores[order].tolist())
+
+    def recommend(self, user_id, how_many=None, exclude=None,
+                  min_ratings=None, filters=()):
+        """Return (game_id, estimated rating) pairs of at most how_many
+        games (all by default) the user has not rated, best first.
+        Only games passing candidate_columns are scored.
+        """
+        row = self.ratings.user_index(user_id)
+        if row is None:
+            return []
+        columns = self.candidate_columns(exclude, min_ratings, filters)
+        scores = self.score_rows([row], columns)[0]
+        return self.recommendation(scores, columns, how_many)
+
+    def ratings_row(self, game_ids, ratings):
+        """Return 1 x games CSR matrix of given ratings,
+        leaving out games the model does not know
+        """
+        columns = self.ratings.game_indices(game_ids)
+        known = columns >= 0
+        order = np.argsort(columns[known])
+        return sparse.csr_matrix(
+            (np.asarray(ratings, dtype=np.float32)[known][order],
+             columns[known][order], [0, int(known.sum())]),
+            shape=(1, self.ratings.shape[1]))
+
+    def recommend_ratings(self, game_ids, ratings, how_many=None,
+                          exclude=None, min_ratings=None, filters=()):
+        """Return what recommend would for a user with given ratings
+        of given games who is not in the model (a group, for example).
+        Neither the model nor the ratings change.
+        """
+        columns = self.candidate_columns(exclude, min_ratings, filters)
+        scores = self.score_ratings(self.ratings_row(game_ids, ratings),
+                                    columns)
+        return self.recommendation(scores, columns, how_many)
+
+    def rows_per_block(self, memory_budget):
+        """Return how many users score_rows can take at once
+        within memory_budget bytes
+        """
+        # about four dense users x games float64 arrays at a time
+        return max(1, memory_budget // (32 * max(self.ratings.shape[1], 1)))
+
+    def recommend_all(self, user_ids=None, how_many=None,
+                      memory_budget=BATCH_MEMORY_BUDGET, exclude=None,
+                      min_ratings=None, filters=()):
+        """Yield (user_id, recommendation) for given users (all by default),
+        each recommendation like recommend returns;
+        users are scored a block at a time
+        """
+        if user_ids is None:
+            user_ids = self.ratings.user_ids
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        rows = self.ratings.index_of(self.ratings.user_ids, user_ids)
+        columns = self.candidate_columns(exclude, min_ratings, filters)
+        block_size = self.rows_per_block(memory_budget)
+        for start in range(0, len(user_ids), block_size):
+            block_rows = rows[start:start + block_size]
+            known = block_rows[block_rows >= 0]
+            scores = iter(
+                self.score_rows(known, columns) if len(known) else [])
+            for user_id, row in zip(user_ids[start:start + block_size],
+                                    block_rows):
+                if row < 0:
+                    yield int(user_id), []
+                else:
+                    yield int(user_id), self.recommendation(
+                        next(scores), columns, how_many)
+
+
+class NeighborhoodRecommender(Recommender):
+    """Engines whose model is a CSR matrix of neighbor weights"""
+
+    def __init__(self, ratings, neighborhood_size, minimal_similarity,
+                 memory_budget, processes, neighbors, reconcile_every):
+        self.neighborhood_size = neighborhood_size
+        self.minimal_similarity = minimal_similarity
+        self.memory_budget = memory_budget
+        self.processes = processes
+        self.reconcile_every = reconcile_every
+        self.updates = 0
+        self.set_ratings(ratings)
+        if neighbors is None:
+            self.fit()
+        else:
+            self.neighbors = neighbors
+
+    def weighted_average(self, rated, columns, numerator, denominator):
+        """Return numerator / denominator (sparse products of weights
+        with ratings and with the rated mask) as scores of score_rows,
+        nan for games rated in the rated mask of the scored users
+        """
+        numerator = numerator.toarray()
+        denominator = denominator.toarray()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scores = numerator / denominator
+        scores[denominator == 0] = np.nan
+        scores[rated[:, columns].toarray() > 0] = np.nan
+        return np.clip(scores, self.min_rating, self.max_rating)
+
+    def model_arrays(self):
+        return {
+            "neighbors_indptr": self.neighbors.indptr,
+            "neighbors_indices": self.neighbors.indices,
+            "neighbors_data": self.neighbors.data,
+        }
+
+    def model_params(self):
+        return {
+            "neighborhood_size": self.neighborhood_size,
+            "minimal_similarity": self.minimal_similarity,
+        }
+
+    @classmethod
+    def from_model(cls, ratings, arrays, params):
+        size = len(arrays["neighbors_indptr"]) - 1
+        neighbors = sparse.csr_matrix(
+            (arrays["neighbors_data"], arrays["neighbors_indices"],
+             arrays["neighbors_indptr"]),
+            shape=(size, size))
+        return cls(ratings, params["neighborhood_size"],
+                   params["minimal_similarity"], neighbors=neighbors)
+
+
+class UserKNNRecommender(NeighborhoodRecommender):
+    """User-based collaborative filtering.
+
+    Users are compared with Pearson correlation over commonly rated games,
+    every user keeps at most neighborhood_size most similar users
+    (with similarity >= minimal_similarity), and a game is scored
+    with the similarity-weighted average of the neighbors' ratings,
+    like Crab's UserBasedRecommender does.
+    """
+
+    engine = "user"
+
+    def __init__(self, ratings, neighborhood_size=NEIGHBORHOOD_SIZE,
+                 minimal_similarity=MINIMAL_SIMILARITY,
+                 memory_budget=SIMILARITY_MEMORY_BUDGET,
+                 processes=SIMILARITY_PROCESSES, neighbors=None,
+                 reconcile_every=RECONCILE_EVERY):
+        self.terms = None
+        NeighborhoodRecommender.__init__(
+            self, ratings, neighborhood_size, minimal_similarity,
+            memory_budget, processes, neighbors, reconcile_every)
+
+    def fit(self):
+        """Compute the neighbors of every user"""
+        self.updates = 0
+        self.terms = None
+        self.neighbors = neighbors_matrix(
+            self.neighbor_blocks(), self.ratings.shape[0])
+
+    def neighbor_blocks(self):
+        """Return (rows, columns, weights) blocks of neighbors
+        of every user, found by comparing all pairs of users
+        """
+        return all_pairs_neighbors(
+            self.ratings.matrix, self.neighborhood_size,
+            self.minimal_similarity, self.memory_budget, self.processes)
+
+    def user_terms(self):
+        """Return pearson_terms of all users, computed once
+        and then kept current by update_model until the next fit
+        """
+        if self.terms is None:
+            self.terms = pearson_terms(self.ratings.matrix)
+        return self.terms
+
+    def update_model(self, previous, row):
+        """Recompute neighbors of the user in given row and the user's
+        place in neighbor lists of others. Only the row of the user
+        changes in the Pearson terms, and the lists of others are
+        patched: the user's weight is changed, the worst neighbor
+        of a full list is replaced, or the user is added or removed.
+        When the user drops out of a full list, the list stays
+        one shorter until the next fit.
+        """
+        num_users = self.ratings.shape[0]
+        added = num_users > previous.shape[0]
+        if self.terms is not None:
+            moved = None
+            if self.ratings.shape[1] > previous.shape[1]:
+                moved = np.searchsorted(
+                    self.ratings.game_ids, previous.game_ids)
+            self.terms = tuple(
+                replace_row(terms, row, changed.indices, changed.data,
+                            added, moved, self.ratings.shape[1])
+                for terms, changed in zip(
+                    self.terms, pearson_terms(self.ratings.matrix[row])))
+        similarity = pearson_block(self.user_terms(), row, row + 1)[0]
+        own = top_neighbors(similarity[None, :], row,
+                            self.neighborhood_size, self.minimal_similarity)
+        similarity[row] = np.nan
+        with np.errstate(invalid="ignore"):
+            candidate = similarity >= self.minimal_similarity
+
+        indptr = self.neighbors.indptr
+        indices = self.neighbors.indices
+        if added:
+            indptr = np.insert(indptr, row, indptr[row])
+            indices = indices + (indices >= row)
+        else:
+            indices = np.array(indices)
+        data = np.array(self.neighbors.data)
+        lengths = np.diff(indptr)
+        mine = np.flatnonzero(indices == row)
+        listed = np.searchsorted(indptr, mine, side="right") - 1
+        stays = candidate[listed]
+        data[mine[stays]] = similarity[listed[stays]]
+        new = candidate.copy()
+        new[listed] = False
+        if self.neighborhood_size:
+            full = lengths >= self.neighborhood_size
+        else:
+            full = np.zeros(num_users, dtype=bool)
+        # the user takes the place of the worst neighbor in full lists
+        rows = np.flatnonzero(new & full)
+        worst = lowest_positions(indptr, data, rows)
+        better = similarity[rows] > data[worst]
+        indices[worst[better]] = row
+        data[worst[better]] = similarity[rows[better]]
+
+        joined = np.flatnonzero(new & ~full)
+        dropped = np.concatenate((
+            mine[~stays], np.arange(indptr[row], indptr[row + 1])))
+        at = np.concatenate((
+            indptr[joined + 1], np.repeat(indptr[row], len(own[1]))))
+        at -= np.searchsorted(np.sort(dropped), at)
+        lengths[listed[~stays]] -= 1
+        lengths[joined] += 1
+        lengths[row] = len(own[1])
+        self.neighbors = sparse.csr_matrix((
+            np.insert(np.delete(data, dropped), at, np.concatenate(
+                (similarity[joined], own[2]))),
+            np.insert(np.delete(indices, dropped), at, np.concatenate(
+                (np.repeat(row, len(joined)), own[1]))),
+            np.concatenate(([0], np.cumsum(lengths))).astype(indptr.dtype)),
+            shape=(num_users, num_users))
+
+    def score_rows(self, rows, columns=None):
+        """Return estimated ratings of all games (or of games
+        in given columns) for given user rows as a dense array,
+        nan where a game cannot be estimated or is already rated
+        """
+        numerator, denominator = self.neighbor_products(
+            self.neighbors[rows], columns)
+        return self.weighted_average(
+            self.rated[rows], all_columns(columns), numerator, denominator)
+
+    def neighbor_products(self, weights, columns=None):
+        """Return products of weights (scored users x users) with ratings
+        and with the rated mask, for games in given columns (all for None).
+        Only rows of the neighbors and only given columns are multiplied.
+        """
+        used = np.unique(weights.indices)
+        weights = weights[:, used]
+        ratings = self.ratings.matrix[used]
+        rated = self.rated[used]
+        if columns is not None:
+            ratings = ratings[:, columns]
+            rated = rated[:, columns]
+        return weights.dot(ratings), weights.dot(rated)
+
+    def score_ratings(self, row, columns=None):
+        """Return estimated ratings like score_rows for a user
+        with ratings in the 1 x games row; the user's neighbors
+        are found among all users first
+        """
+        similarity = pearson_between(
+            pearson_terms(row), self.user_terms())[0]
+        with np.errstate(invalid="ignore"):
+            users = np.flatnonzero(similarity >= self.minimal_similarity)
+        size = self.neighborhood_size
+        if size and size < len(users):
+            users = users[np.argpartition(-similarity[users], size - 1)[:size]]
+        weights = sparse.csr_matrix(
+            (similarity[users], (np.zeros(len(users)), users)),
+            shape=(1, self.ratings.shape[0]))
+        numerator, denominator = self.neighbor_products(weights, columns)
+        return self.weighted_average(
+            binarize(row), all_columns(columns), numerator, denominator)[0]
+
+
+class IndexedUserKNNRecommender(UserKNNRecommender):
+    """User-based collaborative filtering finding neighbors of a user
+    only among the candidates of a random-projection LSH index
+    (see neighbor_index.py) instead of among all users: approximate,
+    but a user is compared with a number of users that does not grow
+    with all of them. The index is built again on every fit;
+    update_user compares the changed user with all users exactly.
+    """
+
+    engine = "user_lsh"
+
+    def neighbor_blocks(self):
+        """Yield (rows, columns, weights) of neighbors of every user
+        among the candidates returned by the neighbor index
+        """
+        index = neighbor_index.RandomProjectionIndex(self.ratings)
+        for row in range(self.ratings.shape[0]):
+            columns, weights = index.query(
+                row, self.neighborhood_size, self.minimal_similarity)
+            yield np.repeat(row, len(columns)), columns, weights
+
+
+class ItemKNNRecommender(NeighborhoodRecommender):
+    """Item-based collaborative filtering.
+
+    Games are compared with Pearson correlation over users who rated
+    both, every game keeps at most neighborhood_size most similar games
+    (with similarity >= minimal_similarity), and a game is scored
+    with the similarity-weighted average of the user's ratings
+    of its neighbors, like Crab's ItemBasedRecommender does.
+    Scoring a user needs only the user's ratings and the game neighbors,
+    so it does not depend on the number of users.
+    """
+
+    engine = "item"
+
+    def __init__(self, ratings, neighborhood_size=ITEM_NEIGHBORHOOD_SIZE,
+                 minimal_similarity=MINIMAL_SIMILARITY,
+                 memory_budget=SIMILARITY_MEMORY_BUDGET,
+                 processes=SIMILARITY_PROCESSES, neighbors=None,
+                 reconcile_every=RECONCILE_EVERY):
+        NeighborhoodRecommender.__init__(
+            self, ratings, neighborhood_size, minimal_similarity,
+            memory_budget, processes, neighbors, reconcile_every)
+
+    def fit(self):
+        """Compute the neighbors of every game"""
+        self.updates = 0
+        blocks = all_pairs_neighbors(
+            self.ratings.matrix.T.tocsr(), self.neighborhood_size,
+            self.minimal_similarity, self.memory_budget, self.processes)
+        self.neighbors = neighbors_matrix(blocks, self.ratings.shape[1])
+
+    def update_model(self, previous, row):
+        """Move game neighbors to the columns of the new ratings matrix.
+        Similarities between games change slowly, so they are
+        recomputed only by fit; new games get no neighbors until then.
+        """
+        if self.ratings.shape[1] == previous.shape[1]:
+            return
+        num_games = self.ratings.shape[1]
+        moved = np.searchsorted(self.ratings.game_ids, previous.game_ids)
+        neighbors = self.neighbors.tocoo()
+        self.neighbors = sparse.csr_matrix(
+            (neighbors.data, (moved[neighbors.row], moved[neighbors.col])),
+            shape=(num_games, num_games))
+
+    def score_rows(self, rows, columns=None):
+        """Return estimated ratings of all games (or of games
+        in given columns) for given user rows as a dense array,
+        nan where a game cannot be estimated or is already rated
+        """
+        return self.score_matrix(self.ratings.matrix[rows], columns)
+
+    def score_ratings(self, row, columns=None):
+        """Return estimated ratings like score_rows for a user
+        with ratings in the 1 x games row
+        """
+        return self.score_matrix(row, columns)[0]
+
+    def score_matrix(self, matrix, columns):
+        """Return estimated ratings for users with ratings
+        in the users x games matrix
+        """
+        columns = all_columns(columns)
+        similar = self.neighbors[columns].T
+        rated = binarize(matrix)
+        return self.weighted_average(
+            rated, columns, matrix.dot(similar), rated.dot(similar))
+
+
+class ALSRecommender(Recommender):
+    """Matrix factorization with alternating least squares.
+
+    Ratings minus their mean are approximated with dot products
+    of user and game factors; the factors of all users are solved
+    with game factors fixed, then the other way round, and so on.
+    Solving is split among threads. Fitting again starts from the
+    factors of previous (another ALSRecommender) or of this recommender,
+    and a changed user only gets new factors (fold_in).
+    """
+
+    engine = "als"
+
+    def __init__(self, ratings, factors=ALS_FACTORS,
+                 regularization=ALS_REGULARIZATION, iterations=ALS_ITERATIONS,
+                 threads=ALS_THREADS, model=None, previous=None,
+                 reconcile_every=RECONCILE_EVERY):
+        self.factors = factors
+        self.regularization = regularization
+        self.iterations = iterations
+        self.threads = threads
+        self.reconcile_every = reconcile_every
+        self.updates = 0
+        self.user_factors = None
+        self.set_ratings(ratings)
+        if model is None:
+            self.fit(previous)
+        else:
+            self.mean, self.user_factors, self.game_factors = model
+
+    def centered(self):
+        centered = self.ratings.matrix.astype(np.float64)
+        centered.data -= self.mean
+        return centered
+
+    def initial_factors(self, previous):
+        """Return random user and game factors,
+        copied from previous for users and games it knows
+        """
+        rng = np.random.RandomState(0)
+        users = rng.normal(0, 0.1, (self.ratings.shape[0], self.factors))
+        games = rng.normal(0, 0.1, (self.ratings.shape[1], self.factors))
+        if previous is not None and previous.factors == self.factors:
+            for factors, ids, previous_factors, previous_ids in (
+                    (users, self.ratings.user_ids,
+                     previous.user_factors, previous.ratings.user_ids),
+                    (games, self.ratings.game_ids,
+                     previous.game_factors, previous.ratings.game_ids)):
+                positions = previous.ratings.index_of(previous_ids, ids)
+                known = positions >= 0
+                factors[known] = previous_factors[positions[known]]
+        return users, games
+
+    def solve(self, pool, matrix, fixed):
+        """Solve factors of all rows of matrix, chunks in parallel"""
+        chunks = np.array_split(
+            np.arange(matrix.shape[0]), 4 * (self.threads or cpu_count()))
+        solved = pool.map(
+            lambda rows: solve_factors(
+                matrix, fixed, self.regularization, rows),
+            chunks)
+        return np.concatenate(solved)
+
+    def fit(self, previous=None):
+        """Compute factors of all users and games"""
+        self.updates = 0
+        if previous is None and self.user_factors is not None:
+            previous = self
+        matrix = self.ratings.matrix
+        self.mean = float(matrix.data.mean()) if matrix.nnz else 0.0
+        by_user = self.centered()
+        by_game = by_user.T.tocsr()
+        users, games = self.initial_factors(previous)
+        iterations = self.iterations
+        if previous is not None:
+            iterations = min(iterations, ALS_WARM_ITERATIONS)
+        pool = ThreadPool(self.threads)
+        try:
+            for _ in range(iterations):
+                users = self.solve(pool, by_user, games)
+                games = self.solve(pool, by_game, users)
+        finally:
+            pool.close()
+        self.user_factors = users.astype(np.float32)
+        self.game_factors = games.astype(np.float32)
+
+    def fold_in(self, game_indices, ratings):
+        """Return factors of a user with given ratings
+        of games (by column), game factors being fixed
+        """
+        row = sparse.csr_matrix(
+            (np.asarray(ratings, dtype=np.float64) - self.mean,
+             np.asarray(game_indices), [0, len(game_indices)]),
+            shape=(1, self.ratings.shape[1]))
+        return solve_factors(
+            row, self.game_factors.astype(np.float64),
+            self.regularization, [0])[0].astype(np.float32)
+
+    def update_model(self, previous, row):
+        """Give the user in given row factors folded in
+        from the user's ratings; new games get zero factors
+        """
+        if self.ratings.shape[1] > previous.shape[1]:
+            moved = np.searchsorted(self.ratings.game_ids, previous.game_ids)
+            games = np.zeros((self.ratings.shape[1], self.factors),
+                             dtype=np.float32)
+            games[moved] = self.game_factors
+            self.game_factors = games
+        if self.ratings.shape[0] > previous.shape[0]:
+            self.user_factors = np.insert(self.user_factors, row, 0, axis=0)
+        elif not self.user_factors.flags.writeable:
+            self.user_factors = np.array(self.user_factors)
+        start, end = (self.ratings.matrix.indptr[row],
+                      self.ratings.matrix.indptr[row + 1])
+        self.user_factors[row] = self.fold_in(
+            self.ratings.matrix.indices[start:end],
+            self.ratings.matrix.data[start:end])
+
+    def score_rows(self, rows, columns=None):
+        """Return estimated ratings of all games (or of games
+        in given columns) for given user rows as a dense array,
+        nan where a game is already rated
+        """
+        return self.estimate(self.user_factors[rows], self.rated[rows],
+                             columns)
+
+    def score_ratings(self, row, columns=None):
+        """Return estimated ratings like score_rows for a user
+        with ratings in the 1 x games row, folded in first
+        """
+        factors = self.fold_in(row.indices, row.data)
+        return self.estimate(factors[None, :], binarize(row), columns)[0]
+
+    def estimate(self, user_factors, rated, columns):
+        """Return estimated ratings of users with given factors,
+        nan where rated (their rated mask) is set
+        """
+        columns = all_columns(columns)
+        scores = self.mean + user_factors.dot(
+            self.game_factors[columns].T).astype(np.float64)
+        scores[rated[:, columns].toarray() > 0] = np.nan
+        return np.clip(scores, self.min_rating, self.max_rating)
+
+    def model_arrays(self):
+        return {
+            "user_factors": self.user_factors,
+            "game_factors": self.game_factors,
+        }
+
+    def model_params(self):
+        return {
+            "mean": self.mean,
+            "factors": self.factors,
+            "regularization": self.regularization,
+            "iterations": self.iterations,
+        }
+
+    @classmethod
+    def from_model(cls, ratings, arrays, params):
+        return cls(ratings, params["factors"], params["regularization"],
+                   params["iterations"], model=(
+                       params["mean"], arrays["user_factors"],
+                       arrays["game_factors"]))
+
+
+# Recommendation engines by name
+ENGINES = {
+    UserKNNRecommender.engine: UserKNNRecommender,
+    IndexedUserKNNRecommender.engine: IndexedUserKNNRecommender,
+    ItemKNNRecommender.engine: ItemKNNRecommender,
+    ALSRecommender.engine: ALSRecommender,
+}
+DEFAULT_ENGINE = UserKNNRecommender.engine
+
+
+def build_recommender(ratings, engine=DEFAULT_ENGINE, previous=None):
+    """Create recommender system using given engine;
+    engines that can start from a previous model of theirs
+    (for other ratings) get previous
+    """
+    print "Building the {} recommender...".format(engine)
+    if previous is not None and engine == ALSRecommender.engine:
+        return ALSRecommender(ratings, previous=previous)
+    return ENGINES[engine](ratings)
@@ -3,16 +3,21 @@
 
 """Recommender system database connection handler"""
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+import hashlib
+import json
+import multiprocessing
 import operator
 import os
 import random
 import sys
 
-import xml.etree.ElementTree as ET
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
 
-import mysql.connector
-from mysql.connector import errorcode
+from db_backends import COUNT_RATINGS, get_backend
 
 
 MYSQL_CONNECTION_DEFAULT_CONFIG = {
@@ -21,6 +26,23 @@ MYSQL_CONNECTION_DEFAULT_CONFIG = {
     "database": "bgg",
 }
 
+# Number of rows sent to the database in one multi-row insert
+INSERT_BATCH_SIZE = 1000
+
+INGEST_MANIFEST_FILE = "ingest_manifest.json"
+
+# Only games rated by more than this many users are recommended
+ELIGIBLE_MIN_RATINGS = 20
+
+# Number of rows fetched at once when streaming ratings
+RATINGS_CHUNK_SIZE = 100000
+
+GAMES_COLUMNS = (
+    "id", "yearpublished", "minplayers", "maxplayers", "name", "age",
+    "description", "noofratings", "avgrating", "bestnumplayers",
+    "langdependence",
+)
+
 
 class Progress:
     """Progress bar"""
@@ -42,253 +64,672 @@ class Progress:
         print
 
 
-class RSDBConnection:
-    """A class that connects to the database and performs all the stuff"""
-
-    def __init__(self, config=MYSQL_CONNECTION_DEFAULT_CONFIG):
+def iter_elements(filename, tag):
+    """Yield `tag` elements of an XML file one by one, as they are parsed.
+    Every element is cleared (together with the already parsed part
+    of the tree) once the caller is done with it, so memory stays flat
+    regardless of the file size.
+    """
+    context = ET.iterparse(filename, events=("start", "end"))
+    _, root = next(context)
+    for event, elem in context:
+        if event == "end" and elem.tag == tag:
+            yield elem
+            elem.clear()
+            root.clear()
+
+
+def find_noofplayers(game):
+    pollresults = {}
+    for poll in game.findall("poll"):
+        if (poll.get("name") == "suggested_numplayers"):
+            for results in poll.findall("results"):
+                numplayers = results.get("numplayers")
+                for result in results.findall("result"):
+                    if result.get("value") == "Best":
+                        numvotes = result.get("numvotes")
+                        pollresults[numplayers] = int(numvotes)
+    if pollresults:
+        return max(pollresults.iteritems(), key=operator.itemgetter(1))[0]
+    else:
+        return None
+
+
+def find_langdependency(game):
+    pollresults = {}
+    for poll in game.findall("poll"):
+        if (poll.get("name") == "language_dependence"):
+            for results in poll.findall("results"):
+                for result in results.findall("result"):
+                    langdependence = result.get("value")
+                    numvotes = result.get("numvotes")
+                    pollresults[langdependence] = int(numvotes)
+    if pollresults:
+        return max(pollresults.iteritems(), key=operator.itemgetter(1))[0]
+    else:
+        return "None"
+
+
+def find_categories(game):
+    categories = []
+    for category in game.findall("boardgamecategory"):
+        categories.append(category.text)
+    return categories
+
+
+def find_mechanics(game):
+    mechanics = []
+    for mechanic in game.findall("boardgamemechanic"):
+        mechanics.append(mechanic.text)
+    return mechanics
+
+
+def parse_game(game):
+    """Return plain rows of a single <boardgame> element:
+    (games row, categories, mechanics), or None if the game is skipped
+    """
+    primary_name = ''
+    if game.find("boardgamecategory") is None:
+        return None
+    if (game.find("statistics").find("ratings")
+            .find("usersrated").text == '0'):
+        return None
+    for name in game.findall("name"):
+        if name.get("primary")=="true":
+            primary_name = name.text
+    if not primary_name:
+        primary_name = game.find("name").text
+    game_row = (
+        game.get("objectid"),
+        game.find("yearpublished").text,
+        game.find("minplayers").text,
+        game.find("maxplayers").text,
+        primary_name,
+        game.find("age").text,
+        game.find("description").text,
+        game.find("statistics").find("ratings").find("usersrated").text,
+        game.find("statistics").find("ratings").find("average").text,
+        find_noofplayers(game),
+        find_langdependency(game)
+        )
+    return game_row, find_categories(game), find_mechanics(game)
+
+
+def parse_game_file(filename):
+    """Parse single game XML file.
+    Return (filename, list of parse_game results),
+    the list is None if the file is broken
+    """
+    games = []
+    try:
+        for game in iter_elements(filename, "boardgame"):
+            rows = parse_game(game)
+            if rows is not None:
+                games.append(rows)
+    except ET.ParseError:
+        return filename, None
+    return filename, games
+
+
+def parse_user_file(filename):
+    """Parse single user XML file.
+    Return (filename, user name, list of (game_id, rating)),
+    the list is None if the file is broken
+    """
+    user = os.path.basename(filename).replace(".xml", "")
+    ratings = []
+    try:
+        for item in iter_elements(filename, "item"):
+            ratings.append((
+                item.get("objectid"),
+                item.find("stats").find("rating").get("value")
+            ))
+    except ET.ParseError:
+        return filename, user, None
+    return filename, user, ratings
+
+
+def list_files(directory):
+    return [directory + "/" + filename
+            for filename in os.listdir(directory)]
+
+
+def file_digest(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as data_file:
+        for chunk in iter(lambda: data_file.read(1 << 16), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def parse_files(parse_fun, paths, processes=None):
+    """Parse given files with a pool of worker processes.
+    Yield results of parse_fun as they come, in no particular order.
+    With processes=1 everything is parsed in the calling process.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    if processes == 1:
+        for path in paths:
+            yield parse_fun(path)
+        return
+    chunksize = max(1, min(64, len(paths) // (8 * processes)))
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(parse_fun, paths, chunksize):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+class IngestManifest:
+    """Size, mtime and content hash of every ingested file,
+    kept in a JSON file between runs of the incremental ingest
+    """
+
+    def __init__(self, filename=INGEST_MANIFEST_FILE):
+        self.filename = filename
         try:
-            self.cnx = mysql.connector.connect(**config)
-        except mysql.connector.Error as err:
-            if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
-                print "Something is wrong with your user name or password"
-            elif err.errno == errorcode.ER_BAD_DB_ERROR:
-                print "Database does not exist"
+            with open(filename) as manifest_file:
+                self.entries = json.load(manifest_file)
+        except IOError:
+            self.entries = {}
+        self.pending = {}
+
+    def changed(self, paths):
+        """Return those of given files that changed since they were
+        ingested. The content is hashed only when size or mtime differ.
+        """
+        changed = []
+        for path in paths:
+            stat = os.stat(path)
+            entry = self.entries.get(path)
+            if (entry and entry["size"] == stat.st_size
+                    and entry["mtime"] == stat.st_mtime):
+                continue
+            new_entry = {
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "sha1": file_digest(path),
+            }
+            if entry and entry["sha1"] == new_entry["sha1"]:
+                self.entries[path] = new_entry
             else:
-                print err
-        else:
-            self.cursor = self.cnx.cursor()
+                self.pending[path] = new_entry
+                changed.append(path)
+        return changed
+
+    def mark_ingested(self, paths):
+        for path in paths:
+            self.entries[path] = self.pending.pop(path)
+
+    def save(self):
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "w") as manifest_file:
+            json.dump(self.entries, manifest_file)
+        os.rename(tmp_filename, self.filename)
+
+
+class BatchInserter:
+    """Collects rows for several tables and writes them in bounded batches,
+    one multi-row insert per table and one transaction per batch.
+
+    Tables are flushed in the order they were added, so tables referenced
+    by foreign keys have to be added first.
+    (mysql.connector's executemany only batches plain "insert into",
+    so the multi-row statement is built here.)
+    """
+
+    def __init__(self, cnx, cursor, batch_size=INSERT_BATCH_SIZE):
+        self.cnx = cnx
+        self.cursor = cursor
+        self.batch_size = batch_size
+        self.statements = OrderedDict()
+        self.rows = {}
+        self.pending = 0
+
+    def add_table(self, table, statement, suffix=""):
+        self.statements[table] = (statement, suffix)
+        self.rows[table] = []
+
+    def add(self, table, row):
+        self.rows[table].append(row)
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self, *tables):
+        """Write pending rows of given tables (all tables by default)"""
+        for table in tables or self.statements.keys():
+            rows = self.rows[table]
+            if not rows:
+                continue
+            statement, suffix = self.statements[table]
+            placeholder = "({})".format(", ".join(["%s"] * len(rows[0])))
+            if suffix:
+                suffix = " " + suffix
+            self.cursor.execute(
+                "{} values {}{};".format(
+                    statement, ", ".join([placeholder] * len(rows)), suffix),
+                [value for row in rows for value in row])
+            self.pending -= len(rows)
+            self.rows[table] = []
+        self.cnx.commit()
 
-    def create_tables(self):
-        self.cursor.execute("""
-            create table if not exists games (
-                id int not null primary key,
-                yearpublished int,
-                minplayers int,
-                maxplayers int,
-                name varchar(64),
-                age int,
-                description varchar(512),
-                noofratings int,
-                avgrating real,
-                bestnumplayers int,
-                langdependence varchar(256)
-            );
-
-            """)
-        self.cursor.execute("""
-            create table if not exists categories (
-                id int not null auto_increment,
-                name varchar(64) unique,
-                primary key (id)
-            );
-        """)
 
-        self.cursor.execute("""
-            create table if not exists gamecategories (
-                game_id int not null,
-                foreign key (game_id) references games(id),
-                category_id int not null,
-                foreign key (category_id) references categories(id)
-            );
-        """)
+class ExplainCursor:
+    """Cursor stand-in that prints EXPLAIN of every query
+    instead of running it. Fetching returns rows (none by default),
+    so that a method which needs a row to go on is explained
+    to the end; fetchmany returns nothing, ending streamed reads.
+    """
+
+    def __init__(self, cursor, backend):
+        self.cursor = cursor
+        self.backend = backend
+        self.rows = []
+
+    def execute(self, query, params=()):
+        print " ".join(query.split())
+        self.cursor.execute(self.backend.explain + query, params)
+        # SQLite has no plan for a plain insert of values
+        description = self.cursor.description or []
+        columns = [column[0] for column in description]
+        for row in self.cursor.fetchall() if description else []:
+            plan = dict(zip(columns, row))
+            print "  {}{}".format(
+                "FULL SCAN " if self.backend.is_full_scan(plan) else "", plan)
+        print
 
-        self.cursor.execute("""
-            create table if not exists mechanics (
-                id int not null auto_increment,
-                name varchar(64) unique,
-                primary key(id)
-            );
-        """)
+    def fetchall(self):
+        return list(self.rows)
 
-        self.cursor.execute("""
-            create table if not exists gamemechanics (
-                game_id int not null,
-                foreign key (game_id) references games(id),
-                mechanic_id int not null,
-                foreign key (mechanic_id) references mechanics(id)
-            );
-        """)
+    def fetchmany(self, size=1):
+        return []
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    @property
+    def rowcount(self):
+        return len(self.rows)
+
+
+class DimensionInterner:
+    """In-memory name -> id map of a dimension table (categories, mechanics).
+    The table is loaded once, unknown names are added in bulk,
+    so known names cost no database round trip at all.
+    """
+
+    def __init__(self, cursor, table):
+        self.cursor = cursor
+        self.table = table
+        self.ids = {}
+        self.cursor.execute("select id, name from {};".format(self.table))
+        self.remember(self.cursor.fetchall())
+
+    def remember(self, rows):
+        for dim_id, name in rows:
+            self.ids[name] = dim_id
 
+    def intern(self, names):
+        """Return ids of given names, adding the missing ones to the table.
+        Ids of missing names are selected by the names as requested,
+        so names the database collation takes for a stored one
+        (other case, accents, trailing spaces) map to its id.
+        """
+        names = [name for name in names if name]
+        missing = list(set(name for name in names if name not in self.ids))
+        if missing:
+            self.cursor.execute(
+                "insert ignore into {} (name) values {};".format(
+                    self.table, ", ".join(["(%s)"] * len(missing))),
+                missing)
+            self.cursor.execute(
+                "select t.id, requested.name from ({}) requested "
+                "join {} t on t.name = requested.name;".format(
+                    " union all ".join(["select %s as name"] * len(missing)),
+                    self.table),
+                missing)
+            self.remember(self.cursor.fetchall())
+        return [self.ids[name] for name in names if name in self.ids]
+
+
+class RSDBConnection:
+    """A class that connects to the database and performs all the stuff.
+
+    The database is MySQL by default, the config may select another
+    backend (see db_backends).
+
+    It can be used as a session: `with RSDBConnection() as rsdbc:`
+    commits (or rolls back) and returns the connection to the pool at exit.
+    """
+
+    def __init__(self, config=MYSQL_CONNECTION_DEFAULT_CONFIG,
+                 eligible_min_ratings=ELIGIBLE_MIN_RATINGS):
+        self.eligible_min_ratings = eligible_min_ratings
+        self.backend = get_backend(config)
+        try:
+            self.cnx = self.backend.acquire()
+        except self.backend.Error as err:
+            print self.backend.describe_error(err)
+        else:
+            self.cursor = self.backend.cursor(self.cnx)
+
+    def create_tables(self):
+        for statement in self.backend.schema:
+            self.cursor.execute(statement)
+        self.migrate()
+
+    def get_schema_version(self):
         self.cursor.execute("""
-            create table if not exists users (
-                id int not null auto_increment,
-                name varchar(64),
-                primary key(id)
+            create table if not exists schemaversion (
+                version int not null primary key
             )
         """)
+        self.cursor.execute("select coalesce(max(version), 0) from schemaversion")
+        return self.cursor.fetchall()[0][0]
 
+    def migrate(self):
+        """Apply migrations the database has not seen yet,
+        skipping steps whose guard tells they are already done
+        """
+        version = self.get_schema_version()
+        for migration_version, steps in self.backend.migrations:
+            if migration_version <= version:
+                continue
+            print "Migrating database to version {}...".format(
+                migration_version)
+            for step in steps:
+                if isinstance(step, tuple):
+                    guard, statement = step
+                    self.cursor.execute(guard)
+                    if not self.cursor.fetchall()[0][0]:
+                        continue
+                else:
+                    statement = step
+                self.cursor.execute(statement)
+            self.cursor.execute(
+                "insert into schemaversion (version) values (%s)",
+                (migration_version,))
+            self.cnx.commit()
+
+    def explain_queries(self):
+        """Print EXPLAIN plans of the queries issued by the read methods
+        and by the writes done per user or per ingest,
+        marking the ones that scan a whole table.
+        Nothing is written, the statements are only explained.
+        """
+        self.cursor.execute("select id, name from users limit 1")
+        user_id, user_name = self.cursor.fetchall()[0]
+        self.cursor.execute("select id from games limit 1")
+        game_id = self.cursor.fetchall()[0][0]
+        game_row = (game_id,) + (None,) * (len(GAMES_COLUMNS) - 1)
+
+        def insert_batches(replace):
+            # two rows a table, for the multi-row statements
+            for batches, rows in (
+                    (self.user_batches(replace=replace),
+                     [("gameratings", (user_id, game_id, 5.0))]),
+                    (self.game_batches(replace=replace),
+                     [("games", game_row),
+                      ("gamecategories", (game_id, 1)),
+                      ("gamemechanics", (game_id, 1))])):
+                for table, row in rows * 2:
+                    batches.add(table, row)
+                batches.flush()
+
+        # (method, arguments, rows the cursor pretends to fetch)
+        calls = [
+            (lambda: list(self.iter_ratings_for_rs()), (), []),
+            (self.get_user_ratings_for_rs, (user_id,), []),
+            (self.get_ratings_watermark, (), []),
+            (self.get_user_names, (), []),
+            (self.add_user, (user_name,), []),
+            (self.insert_user_ratings, (user_id, {game_id: 5.0}),
+             [(game_id,)]),
+            (self.delete_user_ratings, (user_id, [game_id]), []),
+            (self.refresh_rating_counts, (), []),
+            (self.get_user_id, (user_name,), []),
+            (self.get_user_name, (user_id,), []),
+            (self.get_random_user, (), []),
+            (self.get_random_user_group, (2,), []),
+            (self.get_game_name, (game_id,), []),
+            (self.get_numplayers, (game_id,), []),
+            (self.suggest_games_to_rate, (user_id,), []),
+            (self.get_game_full_name, (user_id, "%a%"), []),
+            (self.get_user_ratings, (user_id,), []),
+            (self.get_games_metadata, (), []),
+            (self.get_games_fingerprint, (), []),
+            (self.bump_games_version, (), []),
+            (self.load_dimensions, (), []),
+            (lambda: self.store_game(
+                game_row, [], [], self.game_batches(replace=True),
+                replace=True), (), []),
+            (lambda: self.store_user(
+                user_name, [(game_id, 5.0)], self.user_batches()),
+             (), [(user_id,)]),
+            (insert_batches, (False,), []),
+            (insert_batches, (True,), []),
+        ]
+        cursor = self.cursor
+        self.cursor = ExplainCursor(cursor, self.backend)
+        try:
+            for method, args, rows in calls:
+                self.cursor.rows = rows
+                try:
+                    method(*args)
+                except IndexError:
+                    # the method expected rows, EXPLAIN does not return any
+                    pass
+        finally:
+            self.cursor = cursor
+
+    def refresh_rating_counts(self):
+        """Recount ratings of every game into gameratingcounts.
+        Only ratings of games present in the games table are counted,
+        so ratings of games that failed to ingest make nothing eligible.
+        The ratings version is bumped only if some count changed.
+        """
+        counts = self.get_rating_counts()
+        self.cursor.execute("delete from gameratingcounts;")
+        self.cursor.execute(COUNT_RATINGS)
+        if self.get_rating_counts() != counts:
+            self.bump_ratings_version()
+        self.cnx.commit()
+
+    def get_rating_counts(self):
+        """Return (game_id, noofratings) of games with some rating"""
         self.cursor.execute("""
-            create table if not exists gameratings (
-                user_id int not null,
-                foreign key (user_id) references users(id),
-                game_id int not null,
-                foreign key (game_id) references games(id),
-                rating float,
-                primary key (user_id, game_id)
-            )
+            select game_id, noofratings from gameratingcounts
+            where noofratings > 0
+            order by game_id
         """)
+        return self.cursor.fetchall()
 
-    def find_noofplayers(self, game):
-        pollresults = {}
-        for poll in game.findall("poll"):
-            if (poll.get("name") == "suggested_numplayers"):
-                for results in poll.findall("results"):
-                    numplayers = results.get("numplayers")
-                    for result in results.findall("result"):
-                        if result.get("value") == "Best":
-                            numvotes = result.get("numvotes")
-                            pollresults[numplayers] = int(numvotes)
-        if pollresults:
-            return max(pollresults.iteritems(), key=operator.itemgetter(1))[0]
-        else:
-            return None
+    def bump_ratings_version(self):
+        """Tell readers of get_ratings_watermark that ratings,
+        or the games eligible for recommendation, changed
+        """
+        self.cursor.execute(
+            "update ratingsversion set version = version + 1 where id = 1;")
 
-    def find_langdependency(self, game):
-        pollresults = {}
-        for poll in game.findall("poll"):
-            if (poll.get("name") == "language_dependence"):
-                for results in poll.findall("results"):
-                    for result in results.findall("result"):
-                        langdependence = result.get("value")
-                        numvotes = result.get("numvotes")
-                        pollresults[langdependence] = int(numvotes)
-        if pollresults:
-            return max(pollresults.iteritems(), key=operator.itemgetter(1))[0]
-        else:
-            return "None"
-
-    def find_categories(self, game):
-        categories = []
-        for category in game.findall("boardgamecategory"):
-            categories.append(category.text)
-        return categories
-
-    def find_mechanics(self, game):
-        mechanics = []
-        for mechanic in game.findall("boardgamemechanic"):
-            mechanics.append(mechanic.text)
-        return mechanics
-
-    def process_game(self, filename):
-        """Parse single game XML file"""
-        try:
-            tree = ET.parse(filename)
-            game = tree.getroot().find("boardgame")
-            primary_name = ''
-            if game is None:
-                return False
-            if game.find("boardgamecategory") is None:
-                return False
-            if (game.find("statistics").find("ratings")
-                    .find("usersrated").text == '0'):
-                return False
-            for name in game.findall("name"):
-                if name.get("primary")=="true":
-                    primary_name = name.text
-            if not primary_name:
-                primary_name = game.find("name").text
+    def store_game(self, game_row, categories, mechanics, batches,
+                   replace=False):
+        """Queue rows of a single parsed game.
+        With replace=True previous categories and mechanics are dropped.
+        """
+        game_id = game_row[0]
+        batches.add("games", game_row)
+        if replace:
             self.cursor.execute(
-                "insert ignore into games values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);", (
-                    game.get("objectid"),
-                    game.find("yearpublished").text,
-                    game.find("minplayers").text,
-                    game.find("maxplayers").text,
-                    primary_name,
-                    game.find("age").text,
-                    game.find("description").text,
-                    game.find("statistics").find("ratings").find("usersrated").text,
-                    game.find("statistics").find("ratings").find("average").text,
-                    self.find_noofplayers(game),
-                    self.find_langdependency(game)
-                    ))
-            categories = self.find_categories(game)
-            for category in categories:
-                self.cursor.execute(
-                    "insert ignore into categories (name) values (%s);", ( category,))
-            query = ("select id from categories where name = (%s);")
-            for category in categories:
-                self.cursor.execute(query, (category, ))
-                for (cat_id,) in self.cursor:
-                    self.cursor.execute(
-                        "insert ignore into gamecategories values (%s, %s);", (
-                            game.get("objectid"),
-                            cat_id
-                        ))
-
-            mechanics = self.find_mechanics(game)
-            for mechanic in mechanics:
-                self.cursor.execute(
-                    "insert ignore into mechanics (name) values (%s);", (mechanic,)
-                )
-
-            mechanics_query = ("select id from mechanics where name = (%s);")
-            for mechanic in mechanics:
-                self.cursor.execute(mechanics_query, (mechanic, ))
-                for (mechanic_id,) in self.cursor:
-                    self.cursor.execute(
-                        "insert ignore into gamemechanics values (%s, %s);", (
-                            game.get("objectid"),
-                            mechanic_id
-                        ))
-        except ET.ParseError:
-            self.failed_files.append(filename)
-        return True
-
-    def process_games(self, directory):
+                "delete from gamecategories where game_id = %s;", (game_id,))
+            self.cursor.execute(
+                "delete from gamemechanics where game_id = %s;", (game_id,))
+        for cat_id in self.categories.intern(categories):
+            batches.add("gamecategories", (game_id, cat_id))
+        for mechanic_id in self.mechanics.intern(mechanics):
+            batches.add("gamemechanics", (game_id, mechanic_id))
+
+    def process_games(self, directory, batch_size=INSERT_BATCH_SIZE,
+                      processes=None, manifest=None):
+        """Parse game files in worker processes
+        and write the results to the database from this one.
+        Given a manifest, only changed files are parsed
+        and the games they describe are updated.
+        """
         self.failed_files = []
-        filenames = os.listdir(directory)
-        progress = Progress(len(filenames))
+        self.load_dimensions()
+        batches = self.game_batches(batch_size, replace=manifest is not None)
+        paths = list_files(directory)
+        total = len(paths)
+        if manifest is not None:
+            paths = manifest.changed(paths)
+            print "{} of {} game files changed.".format(len(paths), total)
+        progress = Progress(len(paths))
         count_boardgames = 0
-        for filename in filenames:
+        ingested = []
+        for filename, games in parse_files(
+                parse_game_file, paths, processes):
             progress.update()
-            path = directory + "/" + filename
-            if self.process_game(path):
+            if games is None:
+                self.failed_files.append(filename)
+                continue
+            if games:
                 count_boardgames += 1
+            for game_row, categories, mechanics in games:
+                self.store_game(game_row, categories, mechanics, batches,
+                                replace=manifest is not None)
+            ingested.append(filename)
+        if ingested:
+            self.bump_games_version()
+        batches.flush()
+        if ingested:
+            # ratings count only for games in the games table
+            self.refresh_rating_counts()
         progress.finalize()
+        if manifest is not None:
+            manifest.mark_ingested(ingested)
+            manifest.save()
         print "There are {} board games in total {} games.".format(
-            count_boardgames, len(filenames))
+            count_boardgames, total)
         print "There are {} bad games".format(len(self.failed_files))
 
+    def load_dimensions(self):
+        """Load the category and mechanic names store_game interns"""
+        self.categories = DimensionInterner(self.cursor, "categories")
+        self.mechanics = DimensionInterner(self.cursor, "mechanics")
+
+    def game_batches(self, batch_size=INSERT_BATCH_SIZE, replace=False):
+        """Return BatchInserter of games and their categories
+        and mechanics; with replace=True stored games are updated
+        """
+        batches = BatchInserter(self.cnx, self.cursor, batch_size)
+        if replace:
+            batches.add_table(
+                "games", "insert ignore into games",
+                "on duplicate key update " + ", ".join(
+                    "{0} = values({0})".format(column)
+                    for column in GAMES_COLUMNS[1:]))
+        else:
+            batches.add_table("games", "insert ignore into games")
+        batches.add_table("gamecategories", "insert ignore into gamecategories")
+        batches.add_table("gamemechanics", "insert ignore into gamemechanics")
+        return batches
+
+    def bump_games_version(self):
+        """Tell readers of get_games_fingerprint that games changed"""
+        self.cursor.execute(
+            "update gamesversion set version = version + 1 where id = 1;")
+
     def show_games(self):
         print "Games in database:"
         self.cursor.execute("select * from games;")
         for data in self.cursor:
             print data
 
-    def process_user(self, filename):
-        """Parse single user XML file"""
-        try:
-            tree = ET.parse(filename)
-            items = tree.getroot()
-            user = os.path.basename(filename).replace(".xml", "")
-            if items is None:
-                return False
+    def store_user(self, user, ratings, batches, replace=False):
+        """Queue ratings of a single parsed user.
+        With replace=True the ratings are diffed against the stored ones
+        and only the differences are written.
+        """
+        self.cursor.execute(
+            "insert ignore into users (name) values (%s);", (user, )
+        )
+        query = ("select id from users where name = (%s);")
+        self.cursor.execute(query, (user, ))
+        for (user_id,) in self.cursor.fetchall():
+            if replace:
+                self.replace_user_ratings(user_id, ratings, batches)
+                continue
+            for game_id, rating in ratings:
+                batches.add("gameratings", (user_id, game_id, rating))
+
+    def replace_user_ratings(self, user_id, ratings, batches):
+        """Make stored ratings of the user equal to given ones,
+        touching only the rows that differ
+        """
+        self.cursor.execute(
+            "select game_id, rating from gameratings where user_id = %s;",
+            (user_id,))
+        old_ratings = dict(self.cursor.fetchall())
+        new_ratings = dict(
+            (int(game_id), float(rating)) for game_id, rating in ratings)
+        changed = [(game_id, rating)
+                   for game_id, rating in new_ratings.iteritems()
+                   if old_ratings.get(game_id) != rating]
+        deleted = [game_id for game_id in old_ratings
+                   if game_id not in new_ratings]
+        if changed or deleted:
+            self.bump_ratings_version()
+        for game_id, rating in changed:
+            batches.add("gameratings", (user_id, game_id, rating))
+        added = [game_id for game_id, _ in changed
+                 if game_id not in old_ratings]
+        if added:
+            self.count_new_ratings(added)
+        if deleted:
+            self.delete_user_ratings(user_id, deleted)
+
+    def delete_user_ratings(self, user_id, game_ids):
+        """Delete ratings of given games by the user
+        and uncount them in gameratingcounts
+        """
+        placeholders = ", ".join(["%s"] * len(game_ids))
+        self.cursor.execute(
+            "delete from gameratings where user_id = %s "
+            "and game_id in ({});".format(placeholders),
+            [user_id] + list(game_ids))
+        self.cursor.execute(
+            "update gameratingcounts set noofratings = noofratings - 1 "
+            "where game_id in ({});".format(placeholders),
+            list(game_ids))
+
+    def count_new_ratings(self, game_ids):
+        """Count one more rating of every given game in gameratingcounts;
+        like COUNT_RATINGS, games missing from games are not counted
+        """
+        self.cursor.execute(
+            "select id from games where id in ({});".format(
+                ", ".join(["%s"] * len(game_ids))),
+            list(game_ids))
+        known = [game_id for (game_id,) in self.cursor.fetchall()]
+        if known:
             self.cursor.execute(
-                "insert ignore into users (name) values (%s);", (user, )
-            )
-            query = ("select id from users where name = (%s);")
-            self.cursor.execute(query, (user, ))
-            user_ids = []
-            for (user_id,) in self.cursor:
-                user_ids.append(user_id)
-            for user_id in user_ids:
-                for item in items.findall("item"):
-                    try:
-                        self.cursor.execute(
-                            "insert ignore into gameratings values (%s, %s, %s);", (
-                                user_id,
-                                item.get("objectid"),
-                                item.find("stats").find("rating").get("value")
-                            )
-                        )
-                    except mysql.connector.errors.IntegrityError:
-                        pass
-        except ET.ParseError:
-            self.failed_files.append(filename)
-        return True
+                "insert into gameratingcounts (game_id, noofratings) "
+                "values {} on duplicate key update "
+                "noofratings = noofratings + 1;".format(
+                    ", ".join(["(%s, 1)"] * len(known))),
+                known)
 
     def insert_user_ratings(self, user_id, ratings):
-        """Insert user ratings (from dict)"""
+        """Insert user ratings (from dict)
+        and count them in gameratingcounts
+        """
+        inserted = []
         for game_id, rating in ratings.iteritems():
             self.cursor.execute(
                 "insert ignore into gameratings values (%s, %s, %s);", (
@@ -297,19 +738,63 @@ class RSDBConnection:
                     rating,
                 )
             )
-
-    def process_users(self, directory):
-        filenames = os.listdir(directory)
-        progress = Progress(len(filenames))
+            if self.cursor.rowcount > 0:
+                inserted.append(game_id)
+        if inserted:
+            self.count_new_ratings(inserted)
+            self.bump_ratings_version()
+
+    def process_users(self, directory, batch_size=INSERT_BATCH_SIZE,
+                      processes=None, manifest=None):
+        """Parse user files in worker processes
+        and write the results to the database from this one.
+        Given a manifest, only changed files are parsed
+        and ratings of their users are brought up to date,
+        adjusting the counts of their games; otherwise ratings
+        of all games are counted again when any file was ingested.
+        """
+        self.failed_files = []
+        batches = self.user_batches(batch_size, replace=manifest is not None)
+        paths = list_files(directory)
+        total = len(paths)
+        if manifest is not None:
+            paths = manifest.changed(paths)
+            print "{} of {} user files changed.".format(len(paths), total)
+        progress = Progress(len(paths))
         count_users = 0
-        for filename in filenames:
+        ingested = []
+        for filename, user, ratings in parse_files(
+                parse_user_file, paths, processes):
             progress.update()
-            path = directory + "/" + filename
-            if self.process_user(path):
-                count_users += 1
+            if ratings is None:
+                self.failed_files.append(filename)
+                continue
+            self.store_user(user, ratings, batches,
+                            replace=manifest is not None)
+            count_users += 1
+            ingested.append(filename)
+        batches.flush()
+        if ingested and manifest is None:
+            self.refresh_rating_counts()
         progress.finalize()
+        if manifest is not None:
+            manifest.mark_ingested(ingested)
+            manifest.save()
         print "There are {} users in total {} users.".format(
-            count_users, len(filenames))
+            count_users, total)
+
+    def user_batches(self, batch_size=INSERT_BATCH_SIZE, replace=False):
+        """Return BatchInserter of ratings;
+        with replace=True stored ratings are updated
+        """
+        batches = BatchInserter(self.cnx, self.cursor, batch_size)
+        if replace:
+            batches.add_table(
+                "gameratings", "insert ignore into gameratings",
+                "on duplicate key update rating = values(rating)")
+        else:
+            batches.add_table("gameratings", "insert ignore into gameratings")
+        return batches
 
     def get_data_for_rs(self):
         """Returns a dict containing data for recommender system
@@ -318,15 +803,54 @@ class RSDBConnection:
         self.cursor.execute("""
             select * from gameratings
             where game_id in (
-                select game_id from gameratings
-                group by game_id
-                having count(user_id) > 20)
-        """)
+                select game_id from gameratingcounts
+                where noofratings > %s)
+        """, (self.eligible_min_ratings,))
         result = defaultdict(dict)
         for data in self.cursor:
             result[data[0]][data[1]] = data[2]
         return result
 
+    def iter_ratings_for_rs(self, chunk_size=RATINGS_CHUNK_SIZE):
+        """Yield the ratings get_data_for_rs returns, as lists of
+        (user_id, game_id, rating) tuples in no particular order
+        (sorting them would take a temporary B-tree of all of them,
+        as the eligible games drive the scan through gameratings_game).
+        Rows are streamed from the server, at most chunk_size at a time.
+        """
+        self.cursor.execute("""
+            select user_id, game_id, rating from gameratings
+            where game_id in (
+                select game_id from gameratingcounts
+                where noofratings > %s)
+        """, (self.eligible_min_ratings,))
+        while True:
+            rows = self.cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+
+    def get_user_ratings_for_rs(self, user_id):
+        """Return (game_id, rating) pairs of the user
+        that iter_ratings_for_rs would yield
+        """
+        self.cursor.execute("""
+            select game_id, rating from gameratings
+            where user_id = %s and game_id in (
+                select game_id from gameratingcounts
+                where noofratings > %s)
+        """, (user_id, self.eligible_min_ratings))
+        return self.cursor.fetchall()
+
+    def get_ratings_watermark(self):
+        """Return a value that changes whenever the ratings do:
+        [creation time of the database, ratings version]
+        (see bump_ratings_version)
+        """
+        self.cursor.execute(
+            "select created, version from ratingsversion where id = 1")
+        return [int(value) for value in self.cursor.fetchall()[0]]
+
     def get_user_id(self, user_name):
          self.cursor.execute(
             "select id from users where name = %s",
@@ -339,6 +863,11 @@ class RSDBConnection:
             (user_id,))
          return [item[0] for item in self.cursor][0]
 
+    def get_user_names(self):
+        """Return dict of names of all users by their ids"""
+        self.cursor.execute("select id, name from users")
+        return dict(self.cursor.fetchall())
+
     def get_random_user(self):
         self.cursor.execute(
             "select id from users order by rand() limit 1")
@@ -379,20 +908,39 @@ class RSDBConnection:
         self.cursor.execute("select minplayers, maxplayers from games where id=%s;", (str(game_id),))
         return [(int(item[0]), int(item[1])) for item in self.cursor][0]
 
+    def get_games_metadata(self):
+        """Return (id, name, minplayers, maxplayers, bestnumplayers,
+        avgrating) of all games, ordered by id
+        """
+        self.cursor.execute("""
+            select id, name, minplayers, maxplayers, bestnumplayers, avgrating
+            from games
+            order by id
+        """)
+        return self.cursor.fetchall()
+
+    def get_games_fingerprint(self):
+        """Return a value that changes whenever the games table does:
+        (creation time of the database, games version)
+        (see bump_games_version)
+        """
+        self.cursor.execute(
+            "select created, version from gamesversion where id = 1")
+        return tuple(int(value) for value in self.cursor.fetchall()[0])
+
     def suggest_games_to_rate(self, user_id):
         """Return a game not rated by the user
         """
         self.cursor.execute("""
             select id, name from games
             where id in (
-                select game_id from gameratings
-                group by game_id
-                having count(user_id) > 20)
+                select game_id from gameratingcounts
+                where noofratings > %s)
             and id not in (
                 select game_id from gameratings
                 where user_id = %s)
             order by noofratings desc
-        """, (user_id,))
+        """, (self.eligible_min_ratings, user_id))
         return [(int(item[0]), item[1].encode('utf-8'))
                 for item in self.cursor]
 
@@ -403,15 +951,14 @@ class RSDBConnection:
         self.cursor.execute("""
             select id, name from games
             where id in (
-                select game_id from gameratings
-                group by game_id
-                having count(user_id) > 20)
+                select game_id from gameratingcounts
+                where noofratings > %s)
             and id not in (
                 select game_id from gameratings
                 where user_id = %s)
             and name like %s
             order by noofratings desc
-        """, (user_id,name,))
+        """, (self.eligible_min_ratings, user_id, name))
         return [(int(item[0]), item[1].encode('utf-8'))
                 for item in self.cursor]
 
@@ -427,7 +974,33 @@ class RSDBConnection:
                 for item in self.cursor]
 
     def finalize(self):
-        """Close what __init__ opened"""
-        self.cnx.commit()
-        self.cursor.close()
-        self.cnx.close()
+        """Close what __init__ opened
+        (the connection itself goes back to the pool)
+        """
+        try:
+            self.cnx.commit()
+            self.cursor.close()
+        finally:
+            self.backend.release(self.cnx)
+            self.cnx = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.cnx is not None:
+            self.cnx.rollback()
+        if self.cnx is not None:
+            self.finalize()
+
+
+if __name__ == "__main__":
+    # python rs_db_connection.py migrate|explain
+    rsdbc = RSDBConnection()
+    if sys.argv[1:] == ["migrate"]:
+        rsdbc.migrate()
+    elif sys.argv[1:] == ["explain"]:
+        rsdbc.explain_queries()
+    else:
+        print "Usage: {} migrate|explain".format(sys.argv[0])
+    rsdbc.finalize()
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Single-file container of numpy arrays, read back with memory mapping
+
+Layout: 8 byte magic, 8 byte little-endian header length, JSON header
+(metadata plus dtype, shape and offset of every array), then the raw
+arrays, each aligned to ARRAY_ALIGNMENT bytes.
+"""
+
+import json
+import os
+import struct
+
+import numpy as np
+
+
+MAGIC = b"BGSNAP01"
+ARRAY_ALIGNMENT = 64
+
+
+def align(offset):
+    return (offset + ARRAY_ALIGNMENT - 1) // ARRAY_ALIGNMENT * ARRAY_ALIGNMENT
+
+
+def save_arrays(path, arrays, meta):
+    """Write a dict of arrays and JSON-serializable metadata to path.
+    The file is replaced atomically.
+    """
+    arrays = dict((name, np.ascontiguousarray(array))
+                  for name, array in arrays.iteritems())
+    descriptions = {}
+    offset = 0
+    for name in sorted(arrays):
+        descriptions[name] = {
+            "dtype": arrays[name].dtype.str,
+            "shape": list(arrays[name].shape),
+            "offset": offset,
+        }
+        offset = align(offset + arrays[name].nbytes)
+    header = json.dumps({"meta": meta, "arrays": descriptions})
+    data_start = align(len(MAGIC) + 8 + len(header))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as snapshot_file:
+        snapshot_file.write(MAGIC)
+        snapshot_file.write(struct.pack("<Q", len(header)))
+        snapshot_file.write(header)
+        for name in sorted(arrays):
+            snapshot_file.seek(data_start + descriptions[name]["offset"])
+            snapshot_file.write(arrays[name].tobytes())
+    os.rename(tmp_path, path)
+
+
+def load_arrays(path):
+    """Return (dict of read-only memory-mapped arrays, metadata)
+    of a file written by save_arrays.
+    Raise IOError if the file is missing or is not a snapshot.
+    """
+    with open(path, "rb") as snapshot_file:
+        if snapshot_file.read(len(MAGIC)) != MAGIC:
+            raise IOError("{} is not a snapshot file".format(path))
+        header_length, = struct.unpack("<Q", snapshot_file.read(8))
+        header = json.loads(snapshot_file.read(header_length))
+    data_start = align(len(MAGIC) + 8 + header_length)
+    arrays = {}
+    for name, description in header["arrays"].iteritems():
+        dtype = np.dtype(str(description["dtype"]))
+        shape = tuple(description["shape"])
+        if not np.prod(shape):
+            arrays[name] = np.empty(shape, dtype=dtype)
+            continue
+        arrays[name] = np.memmap(
+            path, dtype=dtype, mode="r", shape=shape,
+            offset=data_start + description["offset"])
+    return arrays, header["meta"]